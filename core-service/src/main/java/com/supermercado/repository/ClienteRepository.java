@@ -1,5 +1,10 @@
 package com.supermercado.repository;
+import org.springframework.data.domain.Pageable;
 import org.springframework.data.jpa.repository.JpaRepository;
 import com.supermercado.model.Cliente;
 
-public interface ClienteRepository extends JpaRepository<Cliente, Long> {}
+import java.util.List;
+
+public interface ClienteRepository extends JpaRepository<Cliente, Long> {
+    List<Cliente> findByIdGreaterThanOrderByIdAsc(Long id, Pageable pageable);
+}
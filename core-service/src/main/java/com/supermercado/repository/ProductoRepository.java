@@ -1,5 +1,10 @@
 package com.supermercado.repository;
+import org.springframework.data.domain.Pageable;
 import org.springframework.data.jpa.repository.JpaRepository;
 import com.supermercado.model.Producto;
 
-public interface ProductoRepository extends JpaRepository<Producto, Long> {}
+import java.util.List;
+
+public interface ProductoRepository extends JpaRepository<Producto, Long> {
+    List<Producto> findByIdGreaterThanOrderByIdAsc(Long id, Pageable pageable);
+}
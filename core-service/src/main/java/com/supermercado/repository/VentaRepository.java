@@ -1,5 +1,10 @@
 package com.supermercado.repository;
+import org.springframework.data.domain.Pageable;
 import org.springframework.data.jpa.repository.JpaRepository;
 import com.supermercado.model.Venta;
 
-public interface VentaRepository extends JpaRepository<Venta, Long> {}
+import java.util.List;
+
+public interface VentaRepository extends JpaRepository<Venta, Long> {
+    List<Venta> findByIdGreaterThanOrderByIdAsc(Long id, Pageable pageable);
+}
@@ -4,6 +4,8 @@ import org.springframework.stereotype.Controller;
 import org.springframework.graphql.data.method.annotation.QueryMapping;
 import org.springframework.graphql.data.method.annotation.MutationMapping;
 import org.springframework.graphql.data.method.annotation.Argument;
+import org.springframework.data.domain.PageRequest;
+import org.springframework.data.domain.Pageable;
 
 import com.supermercado.model.Producto;
 import com.supermercado.repository.ProductoRepository;
@@ -24,8 +26,14 @@ public class ProductoResolver {
     }
     
     @QueryMapping
-    public List<Producto> productos() {
-        return repository.findAll();
+    public List<Producto> productos(@Argument Long desdeId, @Argument Integer limite) {
+        // Sin argumentos se devuelven todos; con desdeId/limite se pagina por id
+        if (desdeId == null && limite == null) {
+            return repository.findAll();
+        }
+        return repository.findByIdGreaterThanOrderByIdAsc(
+            desdeId == null ? 0L : desdeId,
+            limite == null ? Pageable.unpaged() : PageRequest.of(0, limite));
     }
     
     @MutationMapping
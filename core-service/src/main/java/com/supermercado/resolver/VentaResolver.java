@@ -5,6 +5,8 @@ import org.springframework.graphql.data.method.annotation.QueryMapping;
 import org.springframework.graphql.data.method.annotation.MutationMapping;
 import org.springframework.graphql.data.method.annotation.Argument;
 import org.springframework.transaction.annotation.Transactional;
+import org.springframework.data.domain.PageRequest;
+import org.springframework.data.domain.Pageable;
 
 import com.supermercado.model.Venta;
 import com.supermercado.model.DetalleVenta;
@@ -35,8 +37,13 @@ public class VentaResolver {
     
     @QueryMapping
     @Transactional(readOnly = true)
-    public List<Venta> ventas() {
-        List<Venta> ventas = ventaRepository.findAll();
+    public List<Venta> ventas(@Argument Long desdeId, @Argument Integer limite) {
+        // Sin argumentos se devuelven todas; con desdeId/limite se pagina por id (sync incremental)
+        List<Venta> ventas = desdeId == null && limite == null
+            ? ventaRepository.findAll()
+            : ventaRepository.findByIdGreaterThanOrderByIdAsc(
+                desdeId == null ? 0L : desdeId,
+                limite == null ? Pageable.unpaged() : PageRequest.of(0, limite));
         
         // Inicializar relaciones lazy manualmente para evitar LazyInitializationException
         // Esto es seguro y no afecta la API GraphQL
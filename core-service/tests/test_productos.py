@@ -74,6 +74,36 @@ def test_listar_productos(gql_client, producto_test):
     assert producto_test['id'] in ids
 
 
+@pytest.mark.integration
+def test_listar_productos_paginado(gql_client, producto_test):
+    """Test: Paginación por cursor (desdeId + limite) en orden de id"""
+    query = gql("""
+        query {
+          productos(limite: 1) {
+            id
+          }
+        }
+    """)
+    
+    primera_pagina = gql_client.execute(query)['productos']
+    assert len(primera_pagina) == 1
+    
+    query = gql(f"""
+        query {{
+          productos(desdeId: "{primera_pagina[0]['id']}", limite: 50) {{
+            id
+          }}
+        }}
+    """)
+    
+    siguiente = gql_client.execute(query)['productos']
+    ids = [int(prod['id']) for prod in siguiente]
+    
+    assert len(ids) <= 50
+    assert ids == sorted(ids)
+    assert all(i > int(primera_pagina[0]['id']) for i in ids)
+
+
 def test_actualizar_producto(gql_client, producto_test, categoria_test):
     """Test: Actualizar un producto existente"""
     mutation = gql(f"""
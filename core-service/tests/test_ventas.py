@@ -197,6 +197,50 @@ def test_listar_ventas(gql_client, cliente_test, producto_test):
     gql_client.execute(gql(f'mutation {{ deleteVenta(id: "{venta_id}") }}'))
 
 
+@pytest.mark.integration
+def test_listar_ventas_desde_id(gql_client, cliente_test, producto_test):
+    """Test: Listar solo las ventas posteriores a un id (sync incremental)"""
+    venta_ids = []
+    for _ in range(2):
+        create_mutation = gql(f"""
+            mutation {{
+              createVenta(input: {{
+                clienteId: "{cliente_test['id']}"
+                fecha: "2025-10-23"
+                detalles: [
+                  {{
+                    productoId: "{producto_test['id']}"
+                    cantidad: 1
+                    precioUnitario: 10.50
+                  }}
+                ]
+              }}) {{
+                id
+              }}
+            }}
+        """)
+        venta_ids.append(gql_client.execute(create_mutation)['createVenta']['id'])
+    
+    query = gql(f"""
+        query {{
+          ventas(desdeId: "{venta_ids[0]}") {{
+            id
+          }}
+        }}
+    """)
+    
+    result = gql_client.execute(query)
+    ids = [v['id'] for v in result['ventas']]
+    
+    assert venta_ids[0] not in ids
+    assert venta_ids[1] in ids
+    assert all(int(i) > int(venta_ids[0]) for i in ids)
+    
+    # Limpiar
+    for venta_id in venta_ids:
+        gql_client.execute(gql(f'mutation {{ deleteVenta(id: "{venta_id}") }}'))
+
+
 @pytest.mark.integration
 def test_actualizar_venta(gql_client, cliente_test, producto_test):
     """Test: Actualizar una venta existente (cambiar cantidades)"""
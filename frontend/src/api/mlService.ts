@@ -49,9 +49,26 @@ export interface SyncResponse {
   productos_synced: number;
   ventas_synced: number;
   clientes_synced: number;
+  modo: 'incremental' | 'completo';
+  errores: Record<string, string>;
   timestamp: string;
 }
 
+export interface JobResponse {
+  job_id: string;
+  tipo: string;
+  estado: 'pendiente' | 'en_progreso' | 'completado' | 'error';
+  etapa: string | null;
+  progreso: number;
+  resultado: {
+    sync: SyncResponse | null;
+    entrenamiento: Record<string, unknown>;
+  } | null;
+  error: string | null;
+  creado: string;
+  actualizado: string;
+}
+
 export interface HealthResponse {
   status: string;
   service: string;
@@ -106,11 +123,27 @@ class MLServiceAPI {
     return this.request<HealthResponse>('/health');
   }
 
-  // Sync data and train models
-  async sync(): Promise<SyncResponse> {
-    return this.request<SyncResponse>('/sync', {
+  // Sync data and train models (background job, polls until it finishes)
+  async sync(full: boolean = false, pollIntervalMs: number = 1000): Promise<SyncResponse | null> {
+    let job = await this.request<JobResponse>(`/sync${full ? '?full=true' : ''}`, {
       method: 'POST',
     });
+
+    while (job.estado === 'pendiente' || job.estado === 'en_progreso') {
+      await new Promise((resolve) => setTimeout(resolve, pollIntervalMs));
+      job = await this.getJob(job.job_id);
+    }
+
+    if (job.estado === 'error') {
+      throw new Error(`ML Service error: ${job.error}`);
+    }
+
+    return job.resultado?.sync ?? null;
+  }
+
+  // Background job status
+  async getJob(jobId: string): Promise<JobResponse> {
+    return this.request<JobResponse>(`/jobs/${jobId}`);
   }
 
   // Predict price (ML Supervisado)
@@ -3,9 +3,11 @@ Base de datos para ML Service
 Soporta SQLite (desarrollo) y PostgreSQL (Docker/producción)
 Configurado via DATABASE_URL environment variable
 """
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime
+from sqlalchemy import create_engine, event, inspect, text, Column, Index, Integer, String, Float, Boolean, DateTime
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from datetime import datetime
 import os
 
@@ -17,7 +19,49 @@ DATABASE_URL = os.getenv(
     "sqlite:///./ml_cache.db"
 )
 
+# Perfil SQLite (despliegue de un solo nodo): WAL + pragmas por conexión
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))  # bytes
+SQLITE_CACHE_SIZE = int(os.getenv("SQLITE_CACHE_SIZE", "-65536"))  # negativo = KiB (64 MB)
+SQLITE_READ_POOL_SIZE = int(os.getenv("SQLITE_READ_POOL_SIZE", "5"))
+
+
+def _sqlite_pragmas(cursor):
+    """
+    Pragmas de rendimiento (se aplican a cada conexión nueva)
+    synchronous=NORMAL es seguro con WAL: solo se puede perder la última
+    transacción ante un corte de energía, nunca corromper la base
+    """
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    cursor.execute(f"PRAGMA cache_size={SQLITE_CACHE_SIZE}")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+
+
+def _sqlite_write_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")  # persistente en el archivo
+    _sqlite_pragmas(cursor)
+    cursor.close()
+
+
+def _sqlite_read_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    _sqlite_pragmas(cursor)
+    cursor.execute("PRAGMA query_only=ON")
+    cursor.close()
+
+
+def _async_url(url: str) -> str:
+    """Misma base con driver async: asyncpg (PostgreSQL) o aiosqlite (SQLite)"""
+    _, resto = url.split("://", 1)
+    if url.startswith("postgresql"):
+        return f"postgresql+asyncpg://{resto}"
+    return f"sqlite+aiosqlite://{resto}"
+
+
 # Configuración del engine según tipo de BD
+# engine/SessionLocal: sync, trabajos de sync y entrenamiento (procesos aparte)
+# async_read_engine/AsyncReadSessionLocal: endpoints (no bloquean el event loop)
 if DATABASE_URL.startswith("postgresql"):
     engine = create_engine(
         DATABASE_URL,
@@ -26,14 +70,50 @@ if DATABASE_URL.startswith("postgresql"):
         pool_pre_ping=True,  # Verificar conexión antes de usar
         pool_recycle=3600    # Reciclar conexiones cada hora
     )
+    read_engine = engine
+    
+    async_read_engine = create_async_engine(
+        _async_url(DATABASE_URL),
+        pool_size=5,
+        max_overflow=10,
+        pool_pre_ping=True,
+        pool_recycle=3600
+    )
 else:
     # SQLite
     engine = create_engine(
         DATABASE_URL, 
         connect_args={"check_same_thread": False}
     )
+    
+    # aiosqlite usa NullPool por defecto: reutilizar conexiones (y sus pragmas)
+    if ":memory:" in DATABASE_URL or DATABASE_URL in ("sqlite://", "sqlite:///"):
+        # En memoria no hay WAL ni un segundo pool (cada conexión sería otra base)
+        read_engine = engine
+        async_read_engine = create_async_engine(_async_url(DATABASE_URL), poolclass=AsyncAdaptedQueuePool)
+    else:
+        # Pool aparte de solo lectura: con WAL los endpoints de análisis leen el
+        # último snapshot confirmado mientras el sync escribe
+        read_engine = create_engine(
+            DATABASE_URL,
+            connect_args={"check_same_thread": False},
+            pool_size=SQLITE_READ_POOL_SIZE,
+            max_overflow=SQLITE_READ_POOL_SIZE
+        )
+        async_read_engine = create_async_engine(
+            _async_url(DATABASE_URL),
+            poolclass=AsyncAdaptedQueuePool,
+            pool_size=SQLITE_READ_POOL_SIZE,
+            max_overflow=SQLITE_READ_POOL_SIZE
+        )
+        
+        event.listen(engine, "connect", _sqlite_write_pragmas)
+        for _engine in (read_engine, async_read_engine.sync_engine):
+            event.listen(_engine, "connect", _sqlite_read_pragmas)
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
+AsyncReadSessionLocal = async_sessionmaker(async_read_engine, autoflush=False, expire_on_commit=False)
 
 Base = declarative_base()
 
@@ -59,10 +139,29 @@ class VentaCache(Base):
     
     id = Column(Integer, primary_key=True, index=True)
     cliente_id = Column(Integer, index=True)
-    fecha = Column(String)
+    fecha = Column(String, index=True)
     total = Column(Float)
     num_productos = Column(Integer)
     synced_at = Column(DateTime, default=datetime.utcnow)
+    
+    # Resultado del detector de anomalías (se guarda al entrenar)
+    anomaly_score = Column(Float, nullable=True, index=True)  # más negativo = más anómalo
+    is_anomaly = Column(Boolean, nullable=True)
+    razon_anomalia = Column(String, nullable=True)
+    
+    __table_args__ = (
+        # Anomalías ordenadas por score sin recorrer toda la tabla
+        Index("ix_ventas_cache_anomalias", "is_anomaly", "anomaly_score"),
+    )
+
+
+class ClienteCache(Base):
+    """Snapshot de clientes (nombres reales para las métricas)"""
+    __tablename__ = "clientes_cache"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    nombre = Column(String)
+    synced_at = Column(DateTime, default=datetime.utcnow)
 
 
 class ClienteMetrics(Base):
@@ -72,11 +171,12 @@ class ClienteMetrics(Base):
     id = Column(Integer, primary_key=True, index=True)
     cliente_id = Column(Integer, unique=True, index=True)
     nombre = Column(String)
-    total_compras = Column(Float, default=0.0)
-    frecuencia = Column(Integer, default=0)
-    ticket_promedio = Column(Float, default=0.0)
-    segmento = Column(String, nullable=True)  # VIP, Regular, Ocasional
-    updated_at = Column(DateTime, default=datetime.utcnow)
+    # Índices: filtro por segmento y orden/paginación de /ml/segmentacion
+    total_compras = Column(Float, default=0.0, index=True)
+    frecuencia = Column(Integer, default=0, index=True)
+    ticket_promedio = Column(Float, default=0.0, index=True)
+    segmento = Column(String, nullable=True, index=True)  # VIP, Regular, Ocasional
+    updated_at = Column(DateTime, default=datetime.utcnow, index=True)  # métricas recalculadas (no cambia al reasignar segmento)
 
 
 class ModelMetadata(Base):
@@ -89,16 +189,58 @@ class ModelMetadata(Base):
     accuracy = Column(Float, nullable=True)
     samples_count = Column(Integer)
     features = Column(String)  # JSON string
+    version = Column(Integer, nullable=True)  # versión del artefacto en disco (model_store)
+    firma_datos = Column(String, nullable=True)  # JSON: agregados de los datos con que se entrenó
+
+
+class SyncState(Base):
+    """Marca de agua (high-water mark) por entidad para sync incremental"""
+    __tablename__ = "sync_state"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    entidad = Column(String, unique=True)  # ventas (productos y clientes llegan completos), sync
+    ultimo_id = Column(Integer, default=0)  # mayor id sincronizado
+    ultima_fecha = Column(String, nullable=True)  # mayor fecha sincronizada
+    synced_at = Column(DateTime, default=datetime.utcnow)
+
+
+def _add_missing_columns():
+    """
+    Agrega columnas e índices nuevos a tablas ya existentes
+    create_all no altera tablas: la caché de instalaciones previas no los tendría
+    """
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existentes = {c["name"] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existentes:
+                    tipo = column.type.compile(dialect=engine.dialect)
+                    conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {tipo}"))
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
 
 
 # Crear tablas
 Base.metadata.create_all(bind=engine)
+_add_missing_columns()
+
+
+async def dispose_async_engines():
+    """Cierra las conexiones del pool async (llamar en el shutdown de FastAPI)"""
+    await async_read_engine.dispose()
 
 
 # Dependency para FastAPI
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_async_read_db():
+    """
+    Dependency async para endpoints de solo lectura (análisis / dashboard)
+    Las funciones de los servicios son sync: se llaman con
+    `await db.run_sync(funcion, ...)`, que les pasa una Session normal
+    En SQLite usa el pool de solo lectura (no espera al sync); en PostgreSQL
+    es el mismo engine
+    """
+    async with AsyncReadSessionLocal() as db:
         yield db
-    finally:
-        db.close()
@@ -7,18 +7,23 @@ Endpoints REST para:
 - Segmentación de clientes (No Supervisado)
 - Detección de anomalías (Semi-Supervisado)
 """
-from fastapi import FastAPI, Depends, HTTPException
+from fastapi import FastAPI, Depends, HTTPException, Query, Response
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Optional
+from datetime import date
 import logging
 
-from app.database import get_db, ProductoCache, VentaCache, ClienteMetrics
+from app.database import get_async_read_db, dispose_async_engines
 from app.schemas import (
     PredictPriceRequest, PredictPriceResponse,
+    PredictPriceBatchRequest, PredictPriceBatchResponse,
+    SegmentClienteRequest, SegmentClienteBatchRequest,
+    ClienteSegment, SegmentClienteBatchResponse,
     SegmentacionResponse, AnomaliesResponse,
-    SyncResponse, HealthResponse, ModelsResponse
+    JobResponse, HealthResponse, ModelsResponse
 )
-from app.services import data_sync, predictor, segmentacion, anomalias
+from app.services import data_sync, predictor, segmentacion, anomalias, jobs, model_registry, health
 
 # Configurar logging
 logging.basicConfig(
@@ -60,87 +65,111 @@ async def root():
         "endpoints": {
             "docs": "/docs",
             "health": "/health",
+            "liveness": "/health/live",
+            "readiness": "/health/ready",
             "sync": "/sync",
+            "verify_metrics": "/sync/verificar",
+            "jobs": "/jobs/{job_id}",
             "predict_price": "/predict/price",
+            "predict_price_batch": "/predict/price/batch",
             "segmentation": "/ml/segmentacion",
+            "segment_cliente": "/ml/segmentacion/cliente",
             "anomalies": "/ml/anomalias"
         }
     }
 
 
 @app.get("/health", response_model=HealthResponse, tags=["Health"])
-async def health_check(db: Session = Depends(get_db)):
+async def health_check():
     """
     Health check del servicio
-    Verifica conectividad con core-service y estado de modelos
+    Conectividad con core-service, estado de modelos y tamaño de la caché
+    (último valor calculado en segundo plano, ver `checked_at`)
     """
-    core_reachable = await data_sync.check_core_service_health()
-    
-    # Verificar si hay datos en caché
-    productos_count = db.query(ProductoCache).count()
-    ventas_count = db.query(VentaCache).count()
-    clientes_count = db.query(ClienteMetrics).count()
-    
-    models_trained = productos_count > 0 and ventas_count > 0
-    
-    return {
-        "status": "healthy" if core_reachable else "degraded",
-        "service": "ml-service",
-        "core_service_reachable": core_reachable,
-        "models_trained": models_trained,
-        "cache_size": {
-            "productos": productos_count,
-            "ventas": ventas_count,
-            "clientes": clientes_count
-        }
-    }
+    return health.get_status()
+
+
+@app.get("/health/live", tags=["Health"])
+async def liveness():
+    """Liveness probe: el proceso responde (sin I/O)"""
+    return {"status": "alive"}
+
+
+@app.get("/health/ready", response_model=HealthResponse, tags=["Health"])
+async def readiness(response: Response):
+    """
+    Readiness probe: 503 si la base no respondió en el último recálculo
+    core-service caído no lo saca de servicio (status "degraded")
+    """
+    if not health.is_ready():
+        response.status_code = 503
+    return health.get_status()
 
 
-@app.post("/sync", response_model=SyncResponse, tags=["Data Management"])
-async def sync_data(db: Session = Depends(get_db)):
+@app.post("/sync", response_model=JobResponse, status_code=202, tags=["Data Management"])
+async def sync_data(
+    full: bool = Query(False, description="Resincronización completa (limpia y reconstruye la caché)")
+):
     """
-    Sincroniza datos desde core-service y entrena modelos
+    Encola la sincronización desde core-service y el entrenamiento de modelos
+    
+    Retorna de inmediato un trabajo; consultar su avance en `GET /jobs/{job_id}`.
     
-    Pasos:
+    Pasos del trabajo:
     1. Consulta datos via GraphQL desde core-service
+       (incremental por defecto: solo ventas nuevas; `?full=true` para resync completo)
     2. Almacena en caché local (SQLite)
-    3. Entrena los 3 modelos ML:
+    3. Entrena los 3 modelos ML en un proceso aparte (no bloquea el servicio):
        - Predicción de precios (Supervisado)
        - Segmentación de clientes (No Supervisado)
        - Detección de anomalías (Semi-Supervisado)
+       En modo incremental se omiten los modelos cuyos datos no cambiaron.
+    
+    Si ya hay un sync en curso (manual o programado) se retorna ese mismo
+    trabajo en lugar de encolar otro.
+    """
+    logger.info("📥 Encolando sincronización y entrenamiento...")
+    return jobs.submit_sync_job(full=full)
+
+
+@app.post("/sync/verificar", response_model=JobResponse, status_code=202, tags=["Data Management"])
+async def verificar_metricas():
     """
-    logger.info("📥 Iniciando sincronización completa...")
+    Encola la verificación de métricas de clientes
     
-    try:
-        # Sincronizar datos
-        sync_result = await data_sync.sync_data(db)
-        
-        # Entrenar modelos
-        logger.info("🤖 Entrenando modelos ML...")
-        
-        predictor.train_price_predictor(db)
-        segmentacion.train_segmentation(db)
-        anomalias.train_anomaly_detector(db)
-        
-        logger.info("✅ Sincronización y entrenamiento completados")
-        
-        return sync_result
-        
-    except Exception as e:
-        logger.error(f"❌ Error en sincronización: {e}")
-        raise HTTPException(status_code=500, detail=f"Error en sync: {str(e)}")
+    Las métricas (total, frecuencia, ticket promedio) se mantienen con sumas
+    acumuladas en cada sync. Este trabajo las recalcula con un `GROUP BY` sobre
+    la caché de ventas, reporta desviaciones y corrige los clientes afectados.
+    """
+    logger.info("📥 Encolando verificación de métricas...")
+    return jobs.submit_verify_job()
+
+
+@app.get("/jobs/{job_id}", response_model=JobResponse, tags=["Data Management"])
+async def get_job(job_id: str):
+    """
+    Estado de un trabajo de sincronización/entrenamiento
+    
+    **estado:** pendiente, en_progreso, completado, error
+    
+    **resultado:** conteos del sync y métricas de cada modelo al completarse
+    """
+    job = jobs.get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+    return job
 
 
 @app.get("/models", response_model=ModelsResponse, tags=["Models"])
-async def get_models_info(db: Session = Depends(get_db)):
+async def get_models_info(db: AsyncSession = Depends(get_async_read_db)):
     """
     Obtiene información de todos los modelos entrenados
     """
-    models = [
-        predictor.get_model_info(db),
-        segmentacion.get_model_info(db),
-        anomalias.get_model_info(db)
-    ]
+    models = await db.run_sync(lambda session: [
+        predictor.get_model_info(session),
+        segmentacion.get_model_info(session),
+        anomalias.get_model_info(session)
+    ])
     
     return {"models": models}
 
@@ -149,7 +178,12 @@ async def get_models_info(db: Session = Depends(get_db)):
 # ENDPOINTS DE ML
 # ===================================
 
-@app.post("/predict/price", response_model=PredictPriceResponse, tags=["ML - Supervisado"])
+@app.post(
+    "/predict/price",
+    response_model=PredictPriceResponse,
+    tags=["ML - Supervisado"],
+    dependencies=[Depends(model_registry.ensure_fresh)]
+)
 async def predict_price(request: PredictPriceRequest):
     """
     Predice el precio de un producto usando Regresión Lineal
@@ -177,8 +211,47 @@ async def predict_price(request: PredictPriceRequest):
         raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
 
 
-@app.get("/ml/segmentacion", response_model=SegmentacionResponse, tags=["ML - No Supervisado"])
-async def get_segmentacion(db: Session = Depends(get_db)):
+@app.post(
+    "/predict/price/batch",
+    response_model=PredictPriceBatchResponse,
+    tags=["ML - Supervisado"],
+    dependencies=[Depends(model_registry.ensure_fresh)]
+)
+async def predict_price_batch(request: PredictPriceBatchRequest):
+    """
+    Predice el precio de muchos productos en una sola llamada
+    
+    Codifica las categorías de forma vectorizada y ejecuta el modelo una sola vez
+    sobre toda la matriz. Las predicciones vuelven en el mismo orden del request.
+    
+    **Uso:** Sugerir precios para todo el catálogo de nuevos ingresos
+    """
+    try:
+        predicciones = predictor.predict_price_batch(
+            [p.model_dump() for p in request.productos]
+        )
+        return {"total": len(predicciones), "predicciones": predicciones}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error en predicción en lote: {e}")
+        raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
+
+
+@app.get(
+    "/ml/segmentacion",
+    response_model=SegmentacionResponse,
+    tags=["ML - No Supervisado"],
+    dependencies=[Depends(model_registry.ensure_fresh)]
+)
+async def get_segmentacion(
+    segmento: Optional[str] = Query(None, description="VIP, Regular, Ocasional o Sin clasificar"),
+    limit: Optional[int] = Query(None, ge=1, description="Clientes por página (por defecto todos)"),
+    cursor: Optional[str] = Query(None, description="next_cursor de la página anterior"),
+    sort: str = Query("cliente_id", description="cliente_id, total_compras, frecuencia o ticket_promedio ('-' = descendente)"),
+    resumen: bool = Query(False, description="Solo conteos por segmento, sin la lista de clientes"),
+    db: AsyncSession = Depends(get_async_read_db)
+):
     """
     Obtiene la segmentación de clientes usando K-Means
     
@@ -190,17 +263,94 @@ async def get_segmentacion(db: Session = Depends(get_db)):
     **Algoritmo:** K-Means (3 clusters: VIP, Regular, Ocasional)
     
     **Uso:** Identificar clientes VIP para campañas de marketing
+    
+    Los conteos son siempre de todos los clientes; `segmento`, `sort`,
+    `limit` y `cursor` filtran y paginan la lista. Ejemplo:
+    `?segmento=VIP&sort=-total_compras&limit=100`
     """
     try:
-        result = segmentacion.get_segmentation(db)
+        result = await db.run_sync(
+            segmentacion.get_segmentation,
+            segmento=segmento,
+            limit=limit,
+            cursor=cursor,
+            sort=sort,
+            resumen=resumen
+        )
         return result
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"Error en segmentación: {e}")
         raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
 
 
-@app.get("/ml/anomalias", response_model=AnomaliesResponse, tags=["ML - Semi-Supervisado"])
-async def get_anomalias(db: Session = Depends(get_db)):
+@app.post(
+    "/ml/segmentacion/cliente",
+    response_model=ClienteSegment,
+    tags=["ML - No Supervisado"],
+    dependencies=[Depends(model_registry.ensure_fresh)]
+)
+async def segmentar_cliente(request: SegmentClienteRequest, db: AsyncSession = Depends(get_async_read_db)):
+    """
+    Segmento de un cliente con el modelo K-Means en memoria
+    
+    Lee sus métricas de la caché, las escala con el StandardScaler del modelo
+    y asigna el centroide más cercano, sin recorrer la lista de clientes.
+    
+    **Uso:** Personalizar ofertas en el checkout en tiempo real
+    """
+    try:
+        clientes, _ = await db.run_sync(segmentacion.segment_clientes, [request.cliente_id])
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error en segmentación de cliente: {e}")
+        raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
+    
+    if not clientes:
+        raise HTTPException(status_code=404, detail=f"Cliente {request.cliente_id} sin métricas (ejecuta /sync)")
+    return clientes[0]
+
+
+@app.post(
+    "/ml/segmentacion/cliente/batch",
+    response_model=SegmentClienteBatchResponse,
+    tags=["ML - No Supervisado"],
+    dependencies=[Depends(model_registry.ensure_fresh)]
+)
+async def segmentar_clientes_batch(request: SegmentClienteBatchRequest, db: AsyncSession = Depends(get_async_read_db)):
+    """
+    Segmento de varios clientes en una sola llamada
+    
+    Los clientes vuelven en el mismo orden del request; los que no tienen
+    métricas en la caché se listan en `no_encontrados`.
+    """
+    try:
+        clientes, no_encontrados = await db.run_sync(segmentacion.segment_clientes, request.cliente_ids)
+        return {"total": len(clientes), "clientes": clientes, "no_encontrados": no_encontrados}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error en segmentación en lote: {e}")
+        raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
+
+
+@app.get(
+    "/ml/anomalias",
+    response_model=AnomaliesResponse,
+    tags=["ML - Semi-Supervisado"],
+    dependencies=[Depends(model_registry.ensure_fresh)]
+)
+async def get_anomalias(
+    fecha_desde: Optional[date] = Query(None, description="Desde esta fecha (inclusive)"),
+    fecha_hasta: Optional[date] = Query(None, description="Hasta esta fecha (inclusive)"),
+    score_max: Optional[float] = Query(None, description="Solo anomalías con score <= score_max (más negativo = más anómalo)"),
+    cliente_id: Optional[int] = Query(None, description="Solo ventas de este cliente"),
+    limit: Optional[int] = Query(None, ge=1, description="Máximo de anomalías a retornar (por defecto todas)"),
+    offset: int = Query(0, ge=0),
+    db: AsyncSession = Depends(get_async_read_db)
+):
     """
     Detecta ventas anómalas usando Isolation Forest
     
@@ -212,9 +362,21 @@ async def get_anomalias(db: Session = Depends(get_db)):
     **Algoritmo:** Isolation Forest (sklearn)
     
     **Uso:** Detectar posibles fraudes o errores de captura
+    
+    Los scores se calculan al sincronizar y al entrenar y se guardan en la caché:
+    `?fecha_desde=2025-10-01&limit=50` retorna las 50 anomalías más fuertes
+    desde esa fecha sin recorrer todo el historial.
     """
     try:
-        result = anomalias.detect_anomalies(db)
+        result = await db.run_sync(
+            anomalias.detect_anomalies,
+            fecha_desde=fecha_desde,
+            fecha_hasta=fecha_hasta,
+            score_max=score_max,
+            cliente_id=cliente_id,
+            limit=limit,
+            offset=offset
+        )
         return result
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
@@ -231,14 +393,37 @@ async def get_anomalias(db: Session = Depends(get_db)):
 async def startup_event():
     """
     Evento de inicio
-    Crea las tablas de BD si no existen
+    Crea las tablas de BD si no existen, abre el cliente HTTP compartido,
+    lanza el recálculo periódico de /health y el sync programado, y carga los
+    modelos guardados en disco
     """
     logger.info("🚀 ML Service iniciando...")
     logger.info("📊 Base de datos SQLite inicializada")
+    await data_sync.start_http_client()
+    await health.start()
+    jobs.start_scheduler()
+    
+    # Cargar los modelos publicados (predicciones sin esperar a /sync)
+    model_registry.load_all()
     logger.info("✅ Servicio listo en http://localhost:8081")
     logger.info("📖 Documentación en http://localhost:8081/docs")
 
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """
+    Evento de cierre
+    Libera el pool de conexiones HTTP con core-service, el pool de entrenamiento
+    y los pools async de BD
+    """
+    await jobs.stop_scheduler()
+    await health.stop()
+    await data_sync.close_http_client()
+    jobs.shutdown()
+    await dispose_async_engines()
+    logger.info("👋 ML Service detenido")
+
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(
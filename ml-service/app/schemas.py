@@ -2,7 +2,7 @@
 Pydantic schemas para validación de requests/responses
 """
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import Any, Dict, List, Optional
 from datetime import datetime
 
 
@@ -17,11 +17,21 @@ class PredictPriceRequest(BaseModel):
     nombre: str
 
 
+class PredictPriceBatchRequest(BaseModel):
+    """Request para predicción de precios en lote"""
+    productos: List[PredictPriceRequest]
+
+
 class SegmentClienteRequest(BaseModel):
     """Request para segmentación manual de un cliente"""
     cliente_id: int
 
 
+class SegmentClienteBatchRequest(BaseModel):
+    """Request para segmentación de varios clientes"""
+    cliente_ids: List[int]
+
+
 # ===================================
 # RESPONSE SCHEMAS
 # ===================================
@@ -34,6 +44,12 @@ class PredictPriceResponse(BaseModel):
     features_used: List[str]
 
 
+class PredictPriceBatchResponse(BaseModel):
+    """Response de predicción de precios en lote (mismo orden que el request)"""
+    total: int
+    predicciones: List[PredictPriceResponse]
+
+
 class ClienteSegment(BaseModel):
     """Segmento de un cliente"""
     cliente_id: int
@@ -44,6 +60,13 @@ class ClienteSegment(BaseModel):
     ticket_promedio: float
 
 
+class SegmentClienteBatchResponse(BaseModel):
+    """Response de segmentación de varios clientes (mismo orden que el request)"""
+    total: int
+    clientes: List[ClienteSegment]
+    no_encontrados: List[int] = []  # clientes sin métricas en la caché
+
+
 class SegmentacionResponse(BaseModel):
     """Response de clustering completo"""
     total_clientes: int
@@ -51,11 +74,13 @@ class SegmentacionResponse(BaseModel):
     regular_count: int
     ocasional_count: int
     clientes: List[ClienteSegment]
+    next_cursor: Optional[str] = None  # siguiente página (None si es la última)
 
 
 class Anomalia(BaseModel):
     """Venta anómala detectada"""
     venta_id: int
+    cliente_id: Optional[int] = None
     fecha: str
     total: float
     score_anomalia: float
@@ -74,9 +99,24 @@ class SyncResponse(BaseModel):
     productos_synced: int
     ventas_synced: int
     clientes_synced: int
+    modo: str = "incremental"  # incremental | completo
+    errores: Dict[str, str] = {}  # fuente -> error (las demás fuentes se sincronizan igual)
     timestamp: datetime
 
 
+class JobResponse(BaseModel):
+    """Estado de un trabajo en segundo plano (sync + entrenamiento, verificación)"""
+    job_id: str
+    tipo: str
+    estado: str  # pendiente, en_progreso, completado, error
+    etapa: Optional[str]  # sync, price_predictor, customer_segmentation, anomaly_detector, verificacion
+    progreso: int  # 0-100
+    resultado: Optional[Dict[str, Any]]
+    error: Optional[str]
+    creado: datetime
+    actualizado: datetime
+
+
 class HealthResponse(BaseModel):
     """Health check response"""
     status: str
@@ -84,6 +124,7 @@ class HealthResponse(BaseModel):
     core_service_reachable: bool
     models_trained: bool
     cache_size: dict
+    checked_at: Optional[datetime] = None  # último recálculo en segundo plano
 
 
 class ModelInfo(BaseModel):
@@ -93,6 +134,7 @@ class ModelInfo(BaseModel):
     accuracy: Optional[float]
     samples_count: int
     features: List[str]
+    version: Optional[int] = None
 
 
 class ModelsResponse(BaseModel):
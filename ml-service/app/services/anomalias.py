@@ -4,10 +4,12 @@ Isolation Forest con sklearn
 """
 from sklearn.ensemble import IsolationForest
 from sklearn.preprocessing import StandardScaler
-import pandas as pd
+from sqlalchemy import func, update
 from sqlalchemy.orm import Session
+import pandas as pd
 from app.database import VentaCache, ModelMetadata
-from datetime import datetime
+from app.services import features, model_store
+from datetime import datetime, timedelta
 import logging
 
 logger = logging.getLogger(__name__)
@@ -16,9 +18,109 @@ logger = logging.getLogger(__name__)
 _model_cache = {
     "model": None,
     "scaler": None,
-    "trained_at": None
+    "umbrales": None,
+    "trained_at": None,
+    "version": None
 }
 
+def _calcular_umbrales(df) -> dict:
+    """Cuantiles usados para explicar las anomalías (se calculan una vez al entrenar)"""
+    return {
+        "total_alto": float(df["total"].quantile(0.95)),
+        "total_bajo": float(df["total"].quantile(0.05)),
+        "num_productos_alto": float(df["num_productos"].quantile(0.95)),
+        "ticket_promedio_alto": float(df["ticket_promedio"].quantile(0.95))
+    }
+
+
+def _etiquetar_razones(df, umbrales: dict) -> pd.Series:
+    """Razón de cada anomalía con máscaras vectorizadas (sin apply por fila)"""
+    reglas = [
+        (df["total"] > umbrales["total_alto"], "Total muy alto"),
+        (df["total"] < umbrales["total_bajo"], "Total muy bajo"),
+        (df["num_productos"] > umbrales["num_productos_alto"], "Muchos productos"),
+        (df["num_productos"] == 0, "Sin productos"),
+        (df["ticket_promedio"] > umbrales["ticket_promedio_alto"], "Ticket promedio alto"),
+    ]
+    
+    razones = pd.Series("", index=df.index, dtype=object)
+    for mask, texto in reglas:
+        razones = razones.mask(mask, razones + " | " + texto)
+    
+    razones = razones.str[3:]
+    return razones.mask(razones == "", "Patrón inusual")
+
+
+def _puntuar(df) -> None:
+    """Agrega anomaly_score, is_anomaly y razon_anomalia al DataFrame de ventas"""
+    modelo = model_store.snapshot(_model_cache)
+    model = modelo["model"]
+    X_scaled = modelo["scaler"].transform(df[features.VENTA_FEATURES].to_numpy(dtype=float))
+    
+    # Score de anomalía (más negativo = más anómalo)
+    # predict() equivale a score < offset_: se evita recorrer el bosque dos veces
+    df["anomaly_score"] = model.score_samples(X_scaled)
+    df["is_anomaly"] = df["anomaly_score"] < model.offset_
+    
+    # Razón solo para las anomalías
+    # (artefactos anteriores sin umbrales: se calculan sobre estas ventas)
+    umbrales = modelo.get("umbrales") or _calcular_umbrales(df)
+    df["razon_anomalia"] = pd.Series(None, index=df.index, dtype=object)
+    anomalas = df["is_anomaly"]
+    df.loc[anomalas, "razon_anomalia"] = _etiquetar_razones(df[anomalas], umbrales)
+
+
+def _guardar_scores(db: Session, df) -> None:
+    """UPDATE por lotes (executemany por id) de los scores en ventas_cache"""
+    if df.empty:
+        return
+    rows = (
+        df[["venta_id", "anomaly_score", "is_anomaly", "razon_anomalia"]]
+        .rename(columns={"venta_id": "id"})
+        .to_dict("records")
+    )
+    db.execute(update(VentaCache), rows)
+
+
+def score_ventas(db: Session, condicion=None) -> int:
+    """
+    Puntúa ventas con el modelo cargado y guarda el resultado (sin commit)
+    condicion: filtro opcional (por defecto todas las ventas)
+    """
+    df = features.load_ventas(db, condicion=condicion)
+    if df.empty:
+        return 0
+    
+    _puntuar(df)
+    _guardar_scores(db, df)
+    return len(df)
+
+
+def score_pendientes(db: Session) -> int:
+    """
+    Puntúa las ventas aún sin score (p. ej. sincronizadas antes de que hubiera
+    un detector, o caché anterior a esta versión); sin commit
+    """
+    if _model_cache["model"] is None:
+        return 0
+    return score_ventas(db, VentaCache.anomaly_score.is_(None))
+
+
+def score_rows(db: Session, rows: list) -> int:
+    """
+    Puntúa ventas recién sincronizadas (solo el delta) con el modelo en memoria
+    rows: dicts con id, total y num_productos (los mismos del upsert); sin commit
+    """
+    if _model_cache["model"] is None or not rows:
+        return 0
+    
+    df = pd.DataFrame(rows, columns=["id", "total", "num_productos"]).rename(columns={"id": "venta_id"})
+    df["ticket_promedio"] = features.ticket_promedio(df["total"], df["num_productos"])
+    
+    _puntuar(df)
+    _guardar_scores(db, df)
+    return len(df)
+
 
 def train_anomaly_detector(db: Session):
     """
@@ -27,30 +129,15 @@ def train_anomaly_detector(db: Session):
     """
     logger.info("🔍 Entrenando detector de anomalías...")
     
-    # Obtener ventas
-    ventas = db.query(VentaCache).all()
+    # Obtener features de ventas (solo las columnas necesarias)
+    df = features.load_ventas(db)
     
-    if len(ventas) < 20:
+    if len(df) < 20:
         logger.warning("⚠️ Pocas ventas para entrenar (mínimo 20)")
         return None
     
-    # Preparar dataset
-    data = []
-    for v in ventas:
-        # Calcular ticket promedio por producto
-        ticket_prom = v.total / v.num_productos if v.num_productos > 0 else 0
-        
-        data.append({
-            "venta_id": v.id,
-            "total": v.total,
-            "num_productos": v.num_productos,
-            "ticket_promedio": ticket_prom
-        })
-    
-    df = pd.DataFrame(data)
-    
     # Features
-    X = df[["total", "num_productos", "ticket_promedio"]]
+    X = df[features.VENTA_FEATURES].to_numpy(dtype=float)
     
     # Escalar
     scaler = StandardScaler()
@@ -65,10 +152,24 @@ def train_anomaly_detector(db: Session):
     )
     iso_forest.fit(X_scaled)
     
-    # Guardar en caché
-    _model_cache["model"] = iso_forest
-    _model_cache["scaler"] = scaler
-    _model_cache["trained_at"] = datetime.utcnow()
+    # Umbrales para explicar anomalías (parte del modelo)
+    umbrales = _calcular_umbrales(df)
+    
+    artefacto = {
+        "model": iso_forest,
+        "scaler": scaler,
+        "umbrales": umbrales,
+        "trained_at": datetime.utcnow()
+    }
+    
+    # Persistir artefacto versionado (lo cargan otros procesos y reinicios)
+    # y publicarlo en el caché en memoria
+    version = model_store.save_model("anomaly_detector", artefacto)
+    model_store.replace(_model_cache, {**artefacto, "version": version})
+    
+    # Guardar scores de todas las ventas con el nuevo modelo
+    _puntuar(df)
+    _guardar_scores(db, df)
     
     # Guardar metadata
     metadata = db.query(ModelMetadata).filter_by(model_name="anomaly_detector").first()
@@ -77,109 +178,80 @@ def train_anomaly_detector(db: Session):
             model_name="anomaly_detector",
             trained_at=datetime.utcnow(),
             accuracy=None,
-            samples_count=len(ventas),
+            samples_count=len(df),
             features='["total", "num_productos", "ticket_promedio"]'
         )
         db.add(metadata)
     else:
         metadata.trained_at = datetime.utcnow()
-        metadata.samples_count = len(ventas)
+        metadata.samples_count = len(df)
+    
+    # Publicar la versión: los demás workers la detectan y recargan el artefacto
+    metadata.version = version
     
     db.commit()
     
-    logger.info(f"✅ Detector entrenado con {len(ventas)} ventas")
+    logger.info(f"✅ Detector entrenado con {len(df)} ventas")
     
     return {
-        "samples": len(ventas)
+        "samples": len(df)
     }
 
 
-def detect_anomalies(db: Session):
+def detect_anomalies(db: Session, fecha_desde=None, fecha_hasta=None, score_max: float = None,
+                     cliente_id: int = None, limit: int = None, offset: int = 0):
     """
     Detecta ventas anómalas
-    Retorna lista de anomalías con score
+    Retorna lista de anomalías con score (más anómalas primero)
+    
+    Los scores se guardan en ventas_cache al sincronizar y al entrenar: aquí
+    solo se consultan con índices (solo lectura). fecha_desde/fecha_hasta son
+    inclusivas; score_max deja solo anomalías con score <= score_max
+    (más negativo = más anómalo).
     """
     if _model_cache["model"] is None:
         raise ValueError("Modelo no entrenado. Ejecuta /sync primero.")
     
-    model = _model_cache["model"]
-    scaler = _model_cache["scaler"]
+    filtros = []
+    if fecha_desde:
+        filtros.append(VentaCache.fecha >= fecha_desde.isoformat())
+    if fecha_hasta:
+        filtros.append(VentaCache.fecha < (fecha_hasta + timedelta(days=1)).isoformat())
+    if cliente_id is not None:
+        filtros.append(VentaCache.cliente_id == cliente_id)
     
-    # Obtener ventas
-    ventas = db.query(VentaCache).all()
+    total_ventas = db.query(func.count(VentaCache.id)).filter(*filtros).scalar()
     
-    # Preparar dataset
-    data = []
-    for v in ventas:
-        ticket_prom = v.total / v.num_productos if v.num_productos > 0 else 0
-        
-        data.append({
-            "venta_id": v.id,
-            "fecha": v.fecha,
-            "total": v.total,
-            "num_productos": v.num_productos,
-            "ticket_promedio": ticket_prom
-        })
+    query = db.query(
+        VentaCache.id,
+        VentaCache.cliente_id,
+        VentaCache.fecha,
+        VentaCache.total,
+        VentaCache.anomaly_score,
+        VentaCache.razon_anomalia
+    ).filter(VentaCache.is_anomaly.is_(True), *filtros)
+    if score_max is not None:
+        query = query.filter(VentaCache.anomaly_score <= score_max)
     
-    df = pd.DataFrame(data)
+    anomalias_count = query.count()
     
-    # Features
-    X = df[["total", "num_productos", "ticket_promedio"]]
-    X_scaled = scaler.transform(X)
-    
-    # Predecir anomalías
-    # -1 = anomalía, 1 = normal
-    predictions = model.predict(X_scaled)
-    
-    # Calcular score de anomalía (más negativo = más anómalo)
-    scores = model.score_samples(X_scaled)
-    
-    df["is_anomaly"] = predictions
-    df["anomaly_score"] = scores
-    
-    # Filtrar solo anomalías
-    anomalias = df[df["is_anomaly"] == -1].copy()
-    
-    # Determinar razón de anomalía
-    def get_razon(row):
-        razones = []
-        if row["total"] > df["total"].quantile(0.95):
-            razones.append("Total muy alto")
-        if row["total"] < df["total"].quantile(0.05):
-            razones.append("Total muy bajo")
-        if row["num_productos"] > df["num_productos"].quantile(0.95):
-            razones.append("Muchos productos")
-        if row["num_productos"] == 0:
-            razones.append("Sin productos")
-        if row["ticket_promedio"] > df["ticket_promedio"].quantile(0.95):
-            razones.append("Ticket promedio alto")
-        
-        return " | ".join(razones) if razones else "Patrón inusual"
-    
-    anomalias["razon"] = anomalias.apply(get_razon, axis=1)
-    
-    result = {
-        "total_ventas_analizadas": len(ventas),
-        "anomalias_detectadas": len(anomalias),
-        "anomalias": []
-    }
-    
-    for _, row in anomalias.iterrows():
-        result["anomalias"].append({
-            "venta_id": int(row["venta_id"]),
-            "fecha": row["fecha"],
-            "total": float(row["total"]),
-            "score_anomalia": float(row["anomaly_score"]),
-            "razon": row["razon"]
-        })
-    
-    # Ordenar por score (más anómalas primero)
-    result["anomalias"] = sorted(
-        result["anomalias"],
-        key=lambda x: x["score_anomalia"]
-    )
+    rows = query.order_by(VentaCache.anomaly_score, VentaCache.id).offset(offset).limit(limit).all()
     
-    return result
+    return {
+        "total_ventas_analizadas": total_ventas,
+        "anomalias_detectadas": anomalias_count,
+        "anomalias": [
+            {
+                "venta_id": row.id,
+                "cliente_id": row.cliente_id,
+                "fecha": row.fecha,
+                "total": row.total,
+                "score_anomalia": row.anomaly_score,
+                "razon": row.razon_anomalia
+            }
+            for row in rows
+        ]
+    }
 
 
 def get_model_info(db: Session):
@@ -192,6 +264,7 @@ def get_model_info(db: Session):
             "trained_at": metadata.trained_at,
             "accuracy": None,
             "samples_count": metadata.samples_count,
+            "version": metadata.version,
             "features": ["total", "num_productos", "ticket_promedio"]
         }
     
@@ -0,0 +1,111 @@
+"""
+Carga masiva en las tablas de caché
+- SQLite: INSERT ... ON CONFLICT DO UPDATE ejecutado como executemany por lotes
+- PostgreSQL: COPY FROM STDIN a una tabla temporal + INSERT ... ON CONFLICT
+Evita construir un objeto ORM y un INSERT por cada fila
+"""
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+import csv
+import io
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Filas por lote (executemany en SQLite / COPY en PostgreSQL)
+BULK_BATCH_SIZE = int(os.getenv("BULK_BATCH_SIZE", "5000"))
+
+
+def bulk_upsert(db: Session, model, rows: list, key: str = "id",
+                update_columns: list = None, batch_size: int = None,
+                set_expressions: dict = None) -> int:
+    """
+    Inserta o actualiza filas (dicts) en la tabla del modelo
+
+    key: columna única usada para detectar conflictos
+    update_columns: columnas a actualizar si la fila ya existe
+                    (por defecto todas las de la fila salvo la clave)
+    set_expressions: columnas con expresión propia si la fila ya existe
+                     {columna: funcion(tabla, excluded) -> expresión}
+                     (p. ej. sumar el valor nuevo al existente)
+    """
+    if not rows:
+        return 0
+
+    batch_size = batch_size or BULK_BATCH_SIZE
+    set_expressions = set_expressions or {}
+    columns = list(rows[0].keys())
+    if update_columns is None:
+        update_columns = [c for c in columns if c != key and c not in set_expressions]
+
+    dialect = db.get_bind().dialect.name
+
+    for i in range(0, len(rows), batch_size):
+        batch = rows[i:i + batch_size]
+        if dialect == "postgresql":
+            _copy_upsert(db, model.__table__, batch, columns, key, update_columns, set_expressions)
+        else:
+            _executemany_upsert(db, model.__table__, batch, key, update_columns, set_expressions)
+
+    return len(rows)
+
+
+def _on_conflict(stmt, table, key: str, update_columns: list, set_expressions: dict):
+    """ON CONFLICT (key) DO UPDATE / DO NOTHING"""
+    set_ = {c: stmt.excluded[c] for c in update_columns}
+    set_.update({c: expresion(table, stmt.excluded) for c, expresion in set_expressions.items()})
+    if set_:
+        return stmt.on_conflict_do_update(index_elements=[key], set_=set_)
+    return stmt.on_conflict_do_nothing(index_elements=[key])
+
+
+def _executemany_upsert(db: Session, table, rows: list, key: str, update_columns: list,
+                        set_expressions: dict):
+    """INSERT ... ON CONFLICT DO UPDATE con executemany (SQLite)"""
+    stmt = _on_conflict(sqlite_insert(table), table, key, update_columns, set_expressions)
+    db.execute(stmt, rows)
+
+
+def _copy_upsert(db: Session, table, rows: list, columns: list, key: str, update_columns: list,
+                 set_expressions: dict):
+    """
+    COPY FROM STDIN a una tabla temporal y luego INSERT ... SELECT ON CONFLICT (PostgreSQL)
+    La tabla temporal vive en la conexión y se vacía en cada commit
+    """
+    staging = f"_bulk_{table.name}"
+    cols = ", ".join(columns)
+
+    db.execute(text(
+        f"CREATE TEMP TABLE IF NOT EXISTS {staging} "
+        f"(LIKE {table.name} INCLUDING DEFAULTS) ON COMMIT DELETE ROWS"
+    ))
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([_csv_value(row[c]) for c in columns])
+    buffer.seek(0)
+
+    cursor = db.connection().connection.cursor()
+    try:
+        cursor.copy_expert(f"COPY {staging} ({cols}) FROM STDIN WITH (FORMAT csv, NULL '\\N')", buffer)
+    finally:
+        cursor.close()
+
+    stmt = pg_insert(table).from_select(
+        columns,
+        text(f"SELECT {cols} FROM {staging}").columns(*[table.c[c] for c in columns]),
+        include_defaults=False
+    )
+    stmt = _on_conflict(stmt, table, key, update_columns, set_expressions)
+
+    db.execute(stmt)
+    db.execute(text(f"TRUNCATE {staging}"))
+
+
+def _csv_value(value):
+    """Valor para COPY en formato CSV (None -> NULL)"""
+    return "\\N" if value is None else value
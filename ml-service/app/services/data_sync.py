@@ -2,11 +2,18 @@
 Servicio de sincronización con core-service (GraphQL)
 Consulta datos transaccionales y los almacena en caché local
 """
+import asyncio
+import functools
 import httpx
+import math
+import numpy as np
 import os
+from sqlalchemy import func, select, update
 from sqlalchemy.orm import Session
 from datetime import datetime
-from app.database import ProductoCache, VentaCache, ClienteMetrics
+from app.database import ProductoCache, VentaCache, ClienteCache, ClienteMetrics, SyncState
+from app.services import anomalias, features, segmentacion, staging
+from app.services.bulk_loader import bulk_upsert
 import logging
 
 logger = logging.getLogger(__name__)
@@ -14,181 +21,678 @@ logger = logging.getLogger(__name__)
 # Leer desde variable de entorno, con fallback a localhost para desarrollo local
 CORE_SERVICE_URL = os.getenv("CORE_SERVICE_URL", "http://localhost:8080/graphql")
 
+# Paginación de las consultas GraphQL (registros por página) y timeout por página
+SYNC_PAGE_SIZE = int(os.getenv("SYNC_PAGE_SIZE", "1000"))
+CORE_SERVICE_TIMEOUT = float(os.getenv("CORE_SERVICE_TIMEOUT", "30"))
 
-async def fetch_productos():
-    """Consultar productos desde core-service"""
-    query = """
-        query {
-            productos {
-                id
-                nombre
-                precio
-                stock
-                categoria { nombre }
-            }
+# Pool de conexiones HTTP compartido con core-service (vive lo que vive la app)
+CORE_HTTP_MAX_CONNECTIONS = int(os.getenv("CORE_HTTP_MAX_CONNECTIONS", "20"))
+CORE_HTTP_MAX_KEEPALIVE = int(os.getenv("CORE_HTTP_MAX_KEEPALIVE", "10"))
+CORE_HTTP_KEEPALIVE_EXPIRY = float(os.getenv("CORE_HTTP_KEEPALIVE_EXPIRY", "30"))
+CORE_HTTP2 = os.getenv("CORE_HTTP2", "true").lower() == "true"
+
+_http_client = None
+
+# Tamaño de los lotes para consultas IN (...) sobre la caché
+_CHUNK_SIZE = 500
+
+# Queries paginadas por cursor (id ascendente)
+PRODUCTOS_QUERY = """
+    query($desdeId: ID, $limite: Int) {
+        productos(desdeId: $desdeId, limite: $limite) {
+            id
+            nombre
+            precio
+            stock
+            categoria { nombre }
+        }
+    }
+"""
+
+VENTAS_QUERY = """
+    query($desdeId: ID, $limite: Int) {
+        ventas(desdeId: $desdeId, limite: $limite) {
+            id
+            cliente { id }
+            fecha
+            total
+            detalles { id }
+        }
+    }
+"""
+
+CLIENTES_QUERY = """
+    query($desdeId: ID, $limite: Int) {
+        clientes(desdeId: $desdeId, limite: $limite) {
+            id
+            nombre
         }
+    }
+"""
+
+
+async def start_http_client():
     """
-    
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            CORE_SERVICE_URL,
-            json={"query": query},
-            timeout=10.0
+    Crea el cliente HTTP compartido (llamar en el startup de FastAPI)
+    Reutiliza conexiones keep-alive en lugar de abrir una por request
+    """
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(
+            http2=CORE_HTTP2,
+            limits=httpx.Limits(
+                max_connections=CORE_HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=CORE_HTTP_MAX_KEEPALIVE,
+                keepalive_expiry=CORE_HTTP_KEEPALIVE_EXPIRY
+            ),
+            timeout=CORE_SERVICE_TIMEOUT
         )
-        
-        if response.status_code == 200:
-            data = response.json()
-            return data.get("data", {}).get("productos", [])
-        else:
-            logger.error(f"Error fetching productos: {response.status_code}")
-            return []
-
-
-async def fetch_ventas():
-    """Consultar ventas desde core-service"""
-    query = """
-        query {
-            ventas {
-                id
-                cliente { id }
-                fecha
-                total
-                detalles { id }
-            }
-        }
+        logger.info(f"🔌 Cliente HTTP para core-service listo (pool: {CORE_HTTP_MAX_CONNECTIONS}, http2: {CORE_HTTP2})")
+    return _http_client
+
+
+async def close_http_client():
+    """Cierra el cliente HTTP compartido (llamar en el shutdown de FastAPI)"""
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
+async def get_http_client() -> httpx.AsyncClient:
+    """Cliente HTTP compartido (se crea bajo demanda si la app no lo inició)"""
+    return _http_client or await start_http_client()
+
+
+async def _iter_pages(field: str, query: str, desde_id: int = None, page_size: int = None):
+    """
+    Generador asíncrono de páginas de una consulta GraphQL
+    Pagina por cursor (id del último registro recibido) hasta agotar los datos,
+    así nunca se mantiene en memoria más de una página
+    Lanza excepción si core-service responde con error (HTTP o GraphQL)
     """
+    page_size = page_size or SYNC_PAGE_SIZE
+    cursor = desde_id or None
     
-    async with httpx.AsyncClient() as client:
+    client = await get_http_client()
+    
+    while True:
+        variables = {
+            "desdeId": str(cursor) if cursor else None,
+            "limite": page_size
+        }
         response = await client.post(
             CORE_SERVICE_URL,
-            json={"query": query},
-            timeout=10.0
+            json={"query": query, "variables": variables},
+            timeout=CORE_SERVICE_TIMEOUT
         )
         
-        if response.status_code == 200:
-            data = response.json()
-            return data.get("data", {}).get("ventas", [])
-        else:
-            logger.error(f"Error fetching ventas: {response.status_code}")
-            return []
+        # Un error a mitad de la paginación no debe parecer fin de los datos
+        response.raise_for_status()
+        body = response.json()
+        if body.get("errors"):
+            raise RuntimeError(f"Error GraphQL consultando {field}: {body['errors']}")
+        
+        page = (body.get("data") or {}).get(field) or []
+        if not page:
+            return
+        
+        yield page
+        
+        if len(page) < page_size:
+            return
+        cursor = max(int(item["id"]) for item in page)
+
+
+def iter_productos(page_size: int = None):
+    """Páginas de productos desde core-service"""
+    return _iter_pages("productos", PRODUCTOS_QUERY, page_size=page_size)
+
+
+def iter_ventas(desde_id: int = None, page_size: int = None):
+    """
+    Páginas de ventas desde core-service
+    Si se indica desde_id, solo trae las ventas con id mayor (sync incremental)
+    """
+    return _iter_pages("ventas", VENTAS_QUERY, desde_id=desde_id, page_size=page_size)
+
+
+def iter_clientes(page_size: int = None):
+    """Páginas de clientes desde core-service"""
+    return _iter_pages("clientes", CLIENTES_QUERY, page_size=page_size)
+
+
+async def _collect(pages) -> list:
+    """Junta todas las páginas en una lista (solo para volúmenes pequeños)"""
+    return [item async for page in pages for item in page]
+
+
+async def fetch_productos():
+    """Consultar productos desde core-service"""
+    return await _collect(iter_productos())
+
+
+async def fetch_ventas(desde_id: int = None):
+    """
+    Consultar ventas desde core-service
+    Si se indica desde_id, solo trae las ventas con id mayor (sync incremental)
+    """
+    return await _collect(iter_ventas(desde_id=desde_id))
 
 
 async def fetch_clientes():
     """Consultar clientes desde core-service"""
-    query = """
-        query {
-            clientes {
-                id
-                nombre
-                correo
-            }
-        }
+    return await _collect(iter_clientes())
+
+
+def _get_sync_state(db: Session, entidad: str) -> SyncState:
+    """Obtiene (o crea) la marca de agua de una entidad"""
+    state = db.query(SyncState).filter_by(entidad=entidad).first()
+    if not state:
+        state = SyncState(entidad=entidad, ultimo_id=0)
+        db.add(state)
+    return state
+
+
+def _ultimo_id(db: Session, entidad: str):
+    """Marca de agua actual de una entidad (None si no hay)"""
+    return _get_sync_state(db, entidad).ultimo_id or None
+
+
+def ultimo_sync_terminado(db: Session):
+    """Fin del último trabajo de sync exitoso de cualquier proceso (None si no hay)"""
+    state = db.query(SyncState).filter_by(entidad="sync").first()
+    return state.synced_at if state else None
+
+
+def marcar_sync_terminado(db: Session) -> None:
+    """Registra el fin de un trabajo de sync (lo ven los demás workers)"""
+    _get_sync_state(db, "sync").synced_at = datetime.utcnow()
+    db.commit()
+
+
+def _segmento_por_reglas(frecuencia: int, ticket_prom: float) -> str:
+    """Segmentación básica por ticket promedio y frecuencia (sin modelo entrenado)"""
+    if frecuencia >= 4 and ticket_prom >= 25:
+        return "VIP"
+    elif frecuencia >= 2 and ticket_prom >= 12:
+        return "Regular"
+    return "Ocasional"
+
+
+def _refresh_cliente_metrics(db: Session, cliente_ids) -> int:
+    """
+    Recalcula desde cero las métricas de los clientes indicados
+    Agrega desde ventas_cache con GROUP BY y las escribe con un upsert masivo
+    (corrección de desviaciones detectadas por verify_cliente_metrics)
     """
+    cliente_ids = sorted(cliente_ids)
+    refreshed = 0
     
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            CORE_SERVICE_URL,
-            json={"query": query},
-            timeout=10.0
+    for i in range(0, len(cliente_ids), _CHUNK_SIZE):
+        chunk = cliente_ids[i:i + _CHUNK_SIZE]
+        
+        stats = db.query(
+            VentaCache.cliente_id,
+            func.sum(VentaCache.total),
+            func.count(VentaCache.id)
+        ).filter(
+            VentaCache.cliente_id.in_(chunk)
+        ).group_by(VentaCache.cliente_id).all()
+        
+        rows = []
+        for cid, total, count in stats:
+            ticket_prom = total / count if count > 0 else 0
+            rows.append({
+                "cliente_id": cid,
+                "nombre": f"Cliente {cid}",  # Provisional hasta aplicar clientes_cache
+                "total_compras": total,
+                "frecuencia": count,
+                "ticket_promedio": ticket_prom,
+                "updated_at": datetime.utcnow()
+            })
+        
+        # El nombre solo se usa al crear la fila: no pisar el nombre real existente
+        refreshed += bulk_upsert(
+            db, ClienteMetrics, rows, key="cliente_id",
+            update_columns=["total_compras", "frecuencia", "ticket_promedio", "updated_at"]
+        )
+        _asignar_segmentos(db, chunk)
+    
+    return refreshed
+
+
+# Sumas acumuladas: el valor de la página se suma al existente (sin releer el histórico)
+_SUMAR_METRICAS = {
+    "total_compras": lambda t, nuevo: t.c.total_compras + nuevo.total_compras,
+    "frecuencia": lambda t, nuevo: t.c.frecuencia + nuevo.frecuencia,
+    "ticket_promedio": lambda t, nuevo: (
+        (t.c.total_compras + nuevo.total_compras) / (t.c.frecuencia + nuevo.frecuencia)
+    ),
+}
+
+
+def _ventas_nuevas(db: Session, rows: list) -> list:
+    """
+    Ventas de la página que todavía no están en ventas_cache (llamar antes del upsert)
+    El upsert es idempotente pero la suma acumulada no: una página repetida no
+    debe volver a sumarse
+    """
+    por_id = {r["id"]: r for r in rows}
+    ids = list(por_id)
+    existentes = set()
+    for i in range(0, len(ids), _CHUNK_SIZE):
+        existentes.update(
+            vid for (vid,) in db.query(VentaCache.id).filter(VentaCache.id.in_(ids[i:i + _CHUNK_SIZE]))
+        )
+    return [r for vid, r in por_id.items() if vid not in existentes]
+
+
+def _nombres_cambiados(db: Session, rows: list) -> set:
+    """
+    Clientes de la página con nombre nuevo o distinto al de clientes_cache
+    (llamar antes del upsert): el catálogo llega completo en cada sync y solo
+    estos necesitan actualizar el nombre en cliente_metrics
+    """
+    nombres = {r["id"]: r["nombre"] for r in rows}
+    ids = list(nombres)
+    actuales = {}
+    for i in range(0, len(ids), _CHUNK_SIZE):
+        actuales.update(
+            db.query(ClienteCache.id, ClienteCache.nombre).filter(ClienteCache.id.in_(ids[i:i + _CHUNK_SIZE]))
         )
+    return {cid for cid, nombre in nombres.items() if cid not in actuales or actuales[cid] != nombre}
+
+
+def _sumar_metricas(db: Session, ventas: list) -> set:
+    """
+    Suma las ventas nuevas a las métricas de sus clientes
+    El costo depende de las ventas nuevas, no de todo el histórico del cliente
+    ventas: solo las recién insertadas (ver _ventas_nuevas)
+    Retorna los clientes afectados
+    """
+    nuevas = {}
+    for v in ventas:
+        if v["cliente_id"]:
+            total, count = nuevas.get(v["cliente_id"], (0.0, 0))
+            nuevas[v["cliente_id"]] = (total + v["total"], count + 1)
+    
+    ahora = datetime.utcnow()
+    rows = [
+        {
+            "cliente_id": cid,
+            "nombre": f"Cliente {cid}",  # Provisional hasta aplicar clientes_cache
+            "total_compras": total,
+            "frecuencia": count,
+            "ticket_promedio": total / count,
+            "updated_at": ahora
+        }
+        for cid, (total, count) in nuevas.items()
+    ]
+    bulk_upsert(
+        db, ClienteMetrics, rows, key="cliente_id",
+        update_columns=["updated_at"], set_expressions=_SUMAR_METRICAS
+    )
+    
+    _asignar_segmentos(db, nuevas.keys())
+    return set(nuevas)
+
+
+def _asignar_segmentos(db: Session, cliente_ids) -> None:
+    """
+    Segmento de los clientes indicados con sus métricas ya actualizadas
+    Con el modelo de segmentación cargado se asigna el centroide más cercano
+    (vectorizado); las reglas fijas solo se usan en arranque en frío
+    """
+    cliente_ids = sorted(cliente_ids)
+    con_modelo = segmentacion._model_cache["model"] is not None
+    
+    for i in range(0, len(cliente_ids), _CHUNK_SIZE):
+        chunk = cliente_ids[i:i + _CHUNK_SIZE]
+        
+        metricas = db.query(
+            ClienteMetrics.id,
+            ClienteMetrics.total_compras,
+            ClienteMetrics.frecuencia,
+            ClienteMetrics.ticket_promedio
+        ).filter(ClienteMetrics.cliente_id.in_(chunk)).all()
+        if not metricas:
+            continue
         
-        if response.status_code == 200:
-            data = response.json()
-            return data.get("data", {}).get("clientes", [])
+        if con_modelo:
+            X = np.array([[getattr(m, f) for f in features.CLIENTE_FEATURES] for m in metricas], dtype=float)
+            segmentos = segmentacion.asignar_segmentos(X)
         else:
-            logger.error(f"Error fetching clientes: {response.status_code}")
-            return []
+            segmentos = [_segmento_por_reglas(m.frecuencia, m.ticket_promedio) for m in metricas]
+        
+        db.execute(update(ClienteMetrics), [
+            {"id": m.id, "segmento": segmento}
+            for m, segmento in zip(metricas, segmentos)
+        ])
 
 
-async def sync_data(db: Session):
+def verify_cliente_metrics(db: Session, corregir: bool = True) -> dict:
     """
-    Sincroniza todos los datos del core-service
-    Limpia caché anterior y reconstruye
+    Verifica las métricas incrementales contra un GROUP BY sobre ventas_cache
+    Detecta desviaciones (sumas acumuladas que no coinciden con el histórico)
+    y, si corregir=True, recalcula esos clientes y elimina métricas sin ventas
     """
-    logger.info("🔄 Iniciando sincronización con core-service...")
+    logger.info("🔎 Verificando métricas de clientes...")
     
-    # Limpiar caché
-    db.query(ProductoCache).delete()
-    db.query(VentaCache).delete()
-    db.query(ClienteMetrics).delete()
+    esperadas = {
+        cid: (total, count)
+        for cid, total, count in db.query(
+            VentaCache.cliente_id,
+            func.sum(VentaCache.total),
+            func.count(VentaCache.id)
+        ).filter(VentaCache.cliente_id > 0).group_by(VentaCache.cliente_id)
+    }
+    actuales = {
+        cid: (total, count)
+        for cid, total, count in db.query(
+            ClienteMetrics.cliente_id,
+            ClienteMetrics.total_compras,
+            ClienteMetrics.frecuencia
+        )
+    }
     
-    # Sincronizar productos
-    productos = await fetch_productos()
-    productos_count = 0
-    for p in productos:
-        producto_cache = ProductoCache(
-            id=int(p["id"]),
-            nombre=p["nombre"],
-            categoria=p.get("categoria", {}).get("nombre", "Sin categoría") if p.get("categoria") else "Sin categoría",
-            precio=float(p["precio"]),
-            stock=int(p.get("stock", 0))
+    desviados = [
+        cid for cid, (total, count) in esperadas.items()
+        if cid not in actuales
+        or actuales[cid][1] != count
+        or not math.isclose(actuales[cid][0] or 0.0, total, rel_tol=1e-9, abs_tol=1e-6)
+    ]
+    huerfanos = [cid for cid in actuales if cid not in esperadas]
+    
+    if corregir and (desviados or huerfanos):
+        _refresh_cliente_metrics(db, desviados)
+        for i in range(0, len(huerfanos), _CHUNK_SIZE):
+            db.query(ClienteMetrics).filter(
+                ClienteMetrics.cliente_id.in_(huerfanos[i:i + _CHUNK_SIZE])
+            ).delete(synchronize_session=False)
+        _apply_nombres_clientes(db, desviados)
+        db.commit()
+    
+    if desviados or huerfanos:
+        logger.warning(f"⚠️ Métricas desviadas: {len(desviados)}, sin ventas: {len(huerfanos)}")
+    else:
+        logger.info(f"✅ Métricas consistentes ({len(esperadas)} clientes)")
+    
+    return {
+        "clientes_verificados": len(esperadas),
+        "desviados": len(desviados),
+        "sin_ventas": len(huerfanos),
+        "corregidos": corregir and bool(desviados or huerfanos),
+        "timestamp": datetime.utcnow()
+    }
+
+
+def firma_datos(db: Session) -> dict:
+    """
+    Firma barata (agregados) de los datos de entrada de cada modelo
+    Si no cambia entre dos syncs no hace falta reentrenar ese modelo
+    """
+    consultas = {
+        "productos": select(
+            func.count(), func.sum(ProductoCache.precio), func.sum(ProductoCache.stock),
+            func.sum(func.length(ProductoCache.nombre)), func.sum(func.length(ProductoCache.categoria))
+        ),
+        "ventas": select(
+            func.count(), func.max(VentaCache.id),
+            func.sum(VentaCache.total), func.sum(VentaCache.num_productos)
+        ),
+        "clientes": select(
+            func.count(), func.sum(ClienteMetrics.total_compras), func.sum(ClienteMetrics.frecuencia)
+        ),
+    }
+    # Redondeo: las sumas de floats no deben cambiar por el orden de las filas
+    return {
+        fuente: tuple(round(v, 6) if isinstance(v, float) else v for v in db.execute(stmt).one())
+        for fuente, stmt in consultas.items()
+    }
+
+
+def _apply_nombres_clientes(db: Session, cliente_ids) -> None:
+    """
+    Reemplaza el nombre provisional de las métricas por el nombre real de clientes_cache
+    Solo para los clientes tocados en este sync (no recorre toda la tabla)
+    """
+    cliente_ids = list(cliente_ids)
+    nombre_real = select(ClienteCache.nombre).where(
+        ClienteCache.id == ClienteMetrics.cliente_id
+    ).scalar_subquery()
+    
+    for i in range(0, len(cliente_ids), _CHUNK_SIZE):
+        db.query(ClienteMetrics).filter(
+            ClienteMetrics.cliente_id.in_(cliente_ids[i:i + _CHUNK_SIZE])
+        ).update(
+            {ClienteMetrics.nombre: func.coalesce(nombre_real, ClienteMetrics.nombre)},
+            synchronize_session=False
         )
-        db.add(producto_cache)
-        productos_count += 1
+
+
+# ===================================
+# SYNC POR FUENTE
+# Todas comparten la sesión: cada página se escribe y se confirma en un hilo
+# (no bloquea el event loop) bajo un lock, así las fuentes se intercalan solo
+# entre páginas ya confirmadas y la sesión nunca se usa desde dos hilos a la vez.
+# ===================================
+
+async def _en_hilo(fn, *args, lock: asyncio.Lock = None):
+    """Ejecuta trabajo de BD (sync) en un hilo del executor por defecto"""
+    loop = asyncio.get_running_loop()
+    if lock is None:
+        return await loop.run_in_executor(None, functools.partial(fn, *args))
+    async with lock:
+        return await loop.run_in_executor(None, functools.partial(fn, *args))
+
+
+def _guardar_productos(db: Session, page: list) -> int:
+    synced_at = datetime.utcnow()
+    rows = [
+        {
+            "id": int(p["id"]),
+            "nombre": p["nombre"],
+            "categoria": p.get("categoria", {}).get("nombre", "Sin categoría") if p.get("categoria") else "Sin categoría",
+            "precio": float(p["precio"]),
+            "stock": int(p.get("stock", 0)),
+            "synced_at": synced_at
+        }
+        for p in page
+    ]
+    count = bulk_upsert(db, ProductoCache, rows)
+    db.commit()
+    return count
+
+
+async def _sync_productos(db: Session, lock: asyncio.Lock) -> int:
+    """Catálogo completo con upsert: refleja precios/stock actuales"""
+    productos_count = 0
+    
+    async for page in iter_productos():
+        productos_count += await _en_hilo(_guardar_productos, db, page, lock=lock)
+    
+    return productos_count
+
+
+def _guardar_ventas(db: Session, page: list, clientes_afectados: set) -> int:
+    synced_at = datetime.utcnow()
+    rows = [
+        {
+            "id": int(v["id"]),
+            "cliente_id": int(v["cliente"]["id"]) if v.get("cliente") else 0,
+            "fecha": v.get("fecha", ""),
+            "total": float(v["total"]),
+            "num_productos": len(v.get("detalles", [])),
+            "synced_at": synced_at
+        }
+        for v in page
+    ]
+    nuevas = _ventas_nuevas(db, rows)
+    count = bulk_upsert(db, VentaCache, rows)
+    
+    # Score de anomalía solo para las ventas de esta página (alertas sin esperar al reentrenamiento)
+    anomalias.score_rows(db, rows)
+    
+    ventas_state = _get_sync_state(db, "ventas")
+    ventas_state.ultimo_id = max([ventas_state.ultimo_id or 0] + [r["id"] for r in rows])
+    fechas = [r["fecha"] for r in rows if r["fecha"]]
+    if fechas and (not ventas_state.ultima_fecha or max(fechas) > ventas_state.ultima_fecha):
+        ventas_state.ultima_fecha = max(fechas)
+    ventas_state.synced_at = synced_at
     
-    # Sincronizar ventas
-    ventas = await fetch_ventas()
+    # Sumar las ventas nuevas de esta página a las métricas de sus clientes
+    clientes_afectados |= _sumar_metricas(db, nuevas)
+    db.commit()
+    return count
+
+
+async def _sync_ventas(db: Session, lock: asyncio.Lock, clientes_afectados: set) -> int:
+    """
+    Ventas nuevas (posteriores a la marca de agua)
+    La marca de agua avanza por página: si el sync se corta, el siguiente continúa
+    """
+    desde_id = await _en_hilo(_ultimo_id, db, "ventas", lock=lock)
     ventas_count = 0
-    cliente_stats = {}
     
-    for v in ventas:
-        venta_cache = VentaCache(
-            id=int(v["id"]),
-            cliente_id=int(v["cliente"]["id"]) if v.get("cliente") else 0,
-            fecha=v.get("fecha", ""),
-            total=float(v["total"]),
-            num_productos=len(v.get("detalles", []))
-        )
-        db.add(venta_cache)
-        ventas_count += 1
-        
-        # Agregar stats por cliente
-        if v.get("cliente"):
-            cid = int(v["cliente"]["id"])
-            if cid not in cliente_stats:
-                cliente_stats[cid] = {
-                    "nombre": f"Cliente {cid}",  # Nombre simplificado
-                    "total": 0.0,
-                    "count": 0
-                }
-            cliente_stats[cid]["total"] += float(v["total"])
-            cliente_stats[cid]["count"] += 1
-    
-    # Calcular métricas de clientes
+    async for page in iter_ventas(desde_id=desde_id):
+        ventas_count += await _en_hilo(_guardar_ventas, db, page, clientes_afectados, lock=lock)
+    
+    return ventas_count
+
+
+def _guardar_clientes(db: Session, page: list, clientes_nombrados: set) -> int:
+    synced_at = datetime.utcnow()
+    rows = [
+        {"id": int(c["id"]), "nombre": c["nombre"], "synced_at": synced_at}
+        for c in page
+    ]
+    clientes_nombrados |= _nombres_cambiados(db, rows)
+    count = bulk_upsert(db, ClienteCache, rows)
+    db.commit()
+    return count
+
+
+async def _sync_clientes(db: Session, lock: asyncio.Lock, clientes_nombrados: set) -> int:
+    """
+    Catálogo de clientes con upsert (nombres reales)
+    clientes_nombrados: se le agregan los ids cuyo nombre es nuevo o cambió
+    """
     clientes_count = 0
-    for cid, stats in cliente_stats.items():
-        ticket_prom = stats["total"] / stats["count"] if stats["count"] > 0 else 0
-        
-        # Segmentación básica por ticket promedio y frecuencia
-        if stats["count"] >= 4 and ticket_prom >= 25:
-            segmento = "VIP"
-        elif stats["count"] >= 2 and ticket_prom >= 12:
-            segmento = "Regular"
-        else:
-            segmento = "Ocasional"
-        
-        cliente_metric = ClienteMetrics(
-            cliente_id=cid,
-            nombre=stats["nombre"],
-            total_compras=stats["total"],
-            frecuencia=stats["count"],
-            ticket_promedio=ticket_prom,
-            segmento=segmento
-        )
-        db.add(cliente_metric)
-        clientes_count += 1
     
+    async for page in iter_clientes():
+        clientes_count += await _en_hilo(_guardar_clientes, db, page, clientes_nombrados, lock=lock)
+    
+    return clientes_count
+
+
+async def _run_source(db: Session, lock: asyncio.Lock, nombre: str, coro):
+    """Ejecuta una fuente aislando su error: las demás fuentes siguen adelante"""
+    try:
+        return await coro
+    except Exception as e:
+        await _en_hilo(db.rollback, lock=lock)
+        logger.error(f"❌ Error sincronizando {nombre}: {e}")
+        raise
+
+
+def _crear_marcas_de_agua(db: Session) -> None:
+    # Antes de paralelizar: un rollback de una fuente no debe descartar el
+    # estado pendiente de otra
+    _get_sync_state(db, "ventas")
     db.commit()
+
+
+def _finalizar(db: Session, cliente_ids: set) -> None:
+    # Nombres reales de clientes (en lugar de "Cliente {id}"): métricas nuevas
+    # o recalculadas y clientes con nombre nuevo o cambiado en este sync
+    _apply_nombres_clientes(db, cliente_ids)
+    # Ventas que quedaron sin score (sincronizadas antes de haber un detector)
+    anomalias.score_pendientes(db)
+    db.commit()
+
+
+async def _sync_fuentes(db: Session):
+    """
+    Consulta productos, ventas y clientes en paralelo y los guarda con la sesión dada
+    Retorna (productos, ventas, clientes afectados, errores por fuente)
+    """
+    lock = asyncio.Lock()
+    await _en_hilo(_crear_marcas_de_agua, db)
+    
+    clientes_afectados = set()
+    clientes_nombrados = set()
+    fuentes = ["productos", "ventas", "clientes"]
+    resultados = await asyncio.gather(
+        _run_source(db, lock, "productos", _sync_productos(db, lock)),
+        _run_source(db, lock, "ventas", _sync_ventas(db, lock, clientes_afectados)),
+        _run_source(db, lock, "clientes", _sync_clientes(db, lock, clientes_nombrados)),
+        return_exceptions=True
+    )
+    
+    errores = {
+        fuente: str(resultado)
+        for fuente, resultado in zip(fuentes, resultados)
+        if isinstance(resultado, Exception)
+    }
+    if len(errores) == len(fuentes):
+        raise RuntimeError(f"No se pudo sincronizar ninguna fuente: {errores}")
+    
+    productos_count, ventas_count, _ = [
+        0 if isinstance(resultado, Exception) else resultado
+        for resultado in resultados
+    ]
+    
+    await _en_hilo(_finalizar, db, clientes_afectados | clientes_nombrados)
     
-    logger.info(f"✅ Sincronización completada:")
+    return productos_count, ventas_count, clientes_afectados, errores
+
+
+async def sync_data(db: Session, full: bool = False):
+    """
+    Sincroniza los datos del core-service
+    
+    - Incremental (por defecto): solo trae ventas nuevas (id > marca de agua),
+      hace upsert de productos/clientes y recalcula métricas de los clientes afectados.
+      La caché nunca queda vacía durante el proceso.
+    - Completo (full=True): reconstruye todo en tablas de staging y las reemplaza
+      en una sola transacción al final (necesario para reflejar ventas editadas o
+      eliminadas en core-service). Las lecturas siguen viendo la caché anterior
+      completa hasta el swap; si alguna fuente falla se conserva la anterior.
+    
+    Productos, ventas y clientes se consultan en paralelo; en modo incremental,
+    si una fuente falla las otras se guardan igual y el error se reporta en "errores".
+    El trabajo de BD corre en hilos: el event loop sigue atendiendo requests.
+    """
+    modo = "completo" if full else "incremental"
+    logger.info(f"🔄 Iniciando sincronización {modo} con core-service...")
+    
+    if full:
+        staging_ctx = staging.staging_session()
+        staging_db = await _en_hilo(staging_ctx.__enter__)
+        try:
+            productos_count, ventas_count, clientes_afectados, errores = await _sync_fuentes(staging_db)
+            if errores:
+                raise RuntimeError(f"Sync completo cancelado, se conserva la caché anterior: {errores}")
+            await _en_hilo(staging.swap, staging_db)
+        finally:
+            await _en_hilo(staging_ctx.__exit__, None, None, None)
+    else:
+        productos_count, ventas_count, clientes_afectados, errores = await _sync_fuentes(db)
+    
+    clientes_count = len(clientes_afectados)
+    
+    logger.info(f"✅ Sincronización {modo} completada:")
     logger.info(f"   - Productos: {productos_count}")
-    logger.info(f"   - Ventas: {ventas_count}")
-    logger.info(f"   - Clientes: {clientes_count}")
+    logger.info(f"   - Ventas nuevas: {ventas_count}")
+    logger.info(f"   - Clientes actualizados: {clientes_count}")
     
     return {
         "productos_synced": productos_count,
         "ventas_synced": ventas_count,
         "clientes_synced": clientes_count,
+        "modo": modo,
+        "errores": errores,
         "timestamp": datetime.utcnow()
     }
 
@@ -196,13 +700,13 @@ async def sync_data(db: Session):
 async def check_core_service_health():
     """Verificar si core-service está disponible"""
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                CORE_SERVICE_URL,
-                json={"query": "{ __typename }"},
-                timeout=3.0
-            )
-            return response.status_code == 200
+        client = await get_http_client()
+        response = await client.post(
+            CORE_SERVICE_URL,
+            json={"query": "{ __typename }"},
+            timeout=3.0
+        )
+        return response.status_code == 200
     except Exception as e:
         logger.error(f"Core service unreachable: {e}")
         return False
@@ -0,0 +1,83 @@
+"""
+Extracción de features para entrenamiento y scoring
+Selecciona solo las columnas necesarias y las lee directo a pandas/numpy
+(sin cargar objetos ORM ni construir listas de dicts fila por fila)
+"""
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+import numpy as np
+import pandas as pd
+
+from app.database import ProductoCache, VentaCache, ClienteMetrics
+
+PRODUCTO_FEATURES = ["categoria", "stock", "len_nombre"]
+VENTA_FEATURES = ["total", "num_productos", "ticket_promedio"]
+CLIENTE_FEATURES = ["total_compras", "frecuencia", "ticket_promedio"]
+
+
+def _read(db: Session, stmt) -> pd.DataFrame:
+    """Ejecuta el SELECT en la conexión de la sesión y retorna un DataFrame"""
+    return pd.read_sql(stmt, db.connection())
+
+
+def ticket_promedio(total, num_productos) -> np.ndarray:
+    """Ticket promedio por producto (0 si la venta no tiene productos)"""
+    total = np.asarray(total, dtype=float)
+    num_productos = np.asarray(num_productos, dtype=float)
+    return np.divide(total, num_productos, out=np.zeros_like(total), where=num_productos > 0)
+
+
+def load_productos(db: Session) -> pd.DataFrame:
+    """
+    Productos para el predictor de precios
+    Columnas: categoria, stock, len_nombre, precio
+    """
+    df = _read(db, select(
+        ProductoCache.categoria,
+        ProductoCache.stock,
+        func.length(ProductoCache.nombre).label("len_nombre"),
+        ProductoCache.precio
+    ))
+    df["stock"] = df["stock"].fillna(0)
+    df["len_nombre"] = df["len_nombre"].fillna(0)
+    return df
+
+
+def load_ventas(db: Session, con_fecha: bool = False, condicion=None) -> pd.DataFrame:
+    """
+    Ventas para el detector de anomalías
+    Columnas: venta_id, [fecha], total, num_productos, ticket_promedio
+    condicion: filtro opcional (p. ej. VentaCache.anomaly_score.is_(None))
+    """
+    columnas = [VentaCache.id.label("venta_id")]
+    if con_fecha:
+        columnas.append(VentaCache.fecha)
+    columnas += [VentaCache.total, VentaCache.num_productos]
+    
+    stmt = select(*columnas)
+    if condicion is not None:
+        stmt = stmt.where(condicion)
+    
+    df = _read(db, stmt)
+    df["num_productos"] = df["num_productos"].fillna(0)
+    df["ticket_promedio"] = ticket_promedio(df["total"], df["num_productos"])
+    return df
+
+
+def load_clientes(db: Session, condicion=None) -> pd.DataFrame:
+    """
+    Métricas de clientes para segmentación
+    Columnas: id, cliente_id, total_compras, frecuencia, ticket_promedio
+    condicion: filtro opcional (p. ej. clientes actualizados desde una fecha)
+    """
+    stmt = select(
+        ClienteMetrics.id,
+        ClienteMetrics.cliente_id,
+        ClienteMetrics.total_compras,
+        ClienteMetrics.frecuencia,
+        ClienteMetrics.ticket_promedio
+    )
+    if condicion is not None:
+        stmt = stmt.where(condicion)
+    
+    return _read(db, stmt)
@@ -0,0 +1,101 @@
+"""
+Estado de salud del servicio en caché
+Los conteos de la caché y la conectividad con core-service se calculan en una
+tarea de fondo cada HEALTH_REFRESH_INTERVAL segundos; /health y /health/ready
+solo leen el último resultado (sin consultas por cada probe del orquestador)
+"""
+from sqlalchemy import func, select
+from datetime import datetime
+import asyncio
+import os
+import logging
+
+from app.database import AsyncReadSessionLocal, ProductoCache, VentaCache, ClienteMetrics
+from app.services import data_sync
+
+logger = logging.getLogger(__name__)
+
+# Segundos entre recálculos del estado
+HEALTH_REFRESH_INTERVAL = float(os.getenv("HEALTH_REFRESH_INTERVAL", "30"))
+
+_estado = {
+    "status": "starting",
+    "service": "ml-service",
+    "core_service_reachable": False,
+    "models_trained": False,
+    "cache_size": {"productos": 0, "ventas": 0, "clientes": 0},
+    "checked_at": None
+}
+_task = None
+
+
+def get_status() -> dict:
+    """Último estado calculado (no hace I/O)"""
+    return _estado
+
+
+def is_ready() -> bool:
+    """Listo para recibir tráfico: la base respondió en el último recálculo"""
+    return _estado["status"] in ("healthy", "degraded")
+
+
+async def _contar(db, model) -> int:
+    return await db.scalar(select(func.count()).select_from(model))
+
+
+async def refresh() -> dict:
+    """Recalcula conteos y conectividad con core-service y actualiza el caché"""
+    core_reachable = await data_sync.check_core_service_health()
+
+    try:
+        async with AsyncReadSessionLocal() as db:
+            productos_count = await _contar(db, ProductoCache)
+            ventas_count = await _contar(db, VentaCache)
+            clientes_count = await _contar(db, ClienteMetrics)
+    except Exception as e:
+        logger.error(f"❌ Error consultando la caché para /health: {e}")
+        _estado.update(status="unhealthy", core_service_reachable=core_reachable,
+                       checked_at=datetime.utcnow())
+        return _estado
+
+    _estado.update(
+        status="healthy" if core_reachable else "degraded",
+        core_service_reachable=core_reachable,
+        models_trained=productos_count > 0 and ventas_count > 0,
+        cache_size={
+            "productos": productos_count,
+            "ventas": ventas_count,
+            "clientes": clientes_count
+        },
+        checked_at=datetime.utcnow()
+    )
+    return _estado
+
+
+async def _loop():
+    while True:
+        await asyncio.sleep(HEALTH_REFRESH_INTERVAL)
+        try:
+            await refresh()
+        except Exception as e:
+            logger.error(f"❌ Error actualizando estado de salud: {e}")
+
+
+async def start():
+    """Calcula el estado inicial y lanza la tarea de fondo (startup de FastAPI)"""
+    global _task
+    await refresh()
+    if _task is None:
+        _task = asyncio.create_task(_loop())
+
+
+async def stop():
+    """Detiene la tarea de fondo (shutdown de FastAPI)"""
+    global _task
+    if _task is not None:
+        _task.cancel()
+        try:
+            await _task
+        except asyncio.CancelledError:
+            pass
+        _task = None
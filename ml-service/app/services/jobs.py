@@ -0,0 +1,368 @@
+"""
+Cola de trabajos en segundo plano para sync + entrenamiento
+El entrenamiento (CPU intensivo) corre en un pool de procesos para no
+bloquear el event loop de uvicorn; /health y el resto siguen respondiendo
+Un solo sync a la vez (single-flight): los pedidos que llegan durante uno en
+curso, manuales o del scheduler, se unen a ese mismo trabajo
+Entre workers/instancias el sync se serializa con sync_lock; un sync incremental
+que esperó a otro proceso se omite si ese otro terminó después del pedido
+"""
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import OrderedDict
+from datetime import datetime
+import multiprocessing
+import asyncio
+import logging
+import random
+import json
+import uuid
+import os
+
+from app.database import SessionLocal, ModelMetadata
+from app.services import data_sync, predictor, segmentacion, anomalias, model_registry, health, sync_lock
+
+logger = logging.getLogger(__name__)
+
+# Procesos dedicados a entrenar y cantidad de trabajos que se recuerdan
+TRAINING_WORKERS = int(os.getenv("TRAINING_WORKERS", "1"))
+MAX_JOBS_HISTORY = int(os.getenv("MAX_JOBS_HISTORY", "100"))
+
+# Sync incremental programado: segundos entre corridas (0 = desactivado) y
+# desfase aleatorio máximo (evita que varias instancias consulten core-service a la vez)
+SYNC_INTERVAL = float(os.getenv("SYNC_INTERVAL", "900"))
+SYNC_JITTER = float(os.getenv("SYNC_JITTER", "60"))
+
+# Etapas de un trabajo de sync: (nombre, módulo, función de entrenamiento, datos de entrada)
+_ENTRENAMIENTOS = [
+    ("price_predictor", predictor, "train_price_predictor", "productos"),
+    ("customer_segmentation", segmentacion, "train_segmentation", "clientes"),
+    ("anomaly_detector", anomalias, "train_anomaly_detector", "ventas"),
+]
+_ETAPAS = ["sync"] + [nombre for nombre, _, _, _ in _ENTRENAMIENTOS]
+
+# Estados de un trabajo que ya no cambia (se puede descartar del historial)
+_ESTADOS_FINALES = ("completado", "error")
+
+_executor = None
+_jobs = OrderedDict()
+_tasks = set()  # referencias a las tareas en curso (evita que el GC las cancele)
+
+# Single-flight del sync: trabajo en curso y, a lo sumo, un sync completo encolado detrás
+_sync_lock = None
+_sync_actual = None
+_sync_pendiente = None
+_scheduler_task = None
+
+
+def _init_worker():
+    """Inicializa el proceso de entrenamiento (mismo formato de logs que la app)"""
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+
+
+def _train_in_process(nombre: str, full: bool = False, firma: str = None):
+    """
+    Entrena un modelo dentro del proceso hijo
+    El entrenamiento publica el artefacto y su versión (model_store + model_metadata)
+    full: viene de un sync completo (la segmentación no usa su modo incremental)
+    firma: firma de los datos de entrada; se guarda junto a la versión publicada
+    """
+    _, module, funcion, _ = next(e for e in _ENTRENAMIENTOS if e[0] == nombre)
+    entrenar = getattr(module, funcion)
+    db = SessionLocal()
+    try:
+        if full and module is segmentacion:
+            resultado = entrenar(db, full=True)
+        else:
+            resultado = entrenar(db)
+        _publicar_firma(db, nombre, firma)
+        return resultado
+    finally:
+        db.close()
+
+
+def _publicar_firma(db, nombre: str, firma: str) -> None:
+    """Registra con qué datos se entrenó el modelo publicado (la leen todos los workers)"""
+    metadata = db.query(ModelMetadata).filter_by(model_name=nombre).first()
+    if metadata:
+        metadata.firma_datos = firma
+        db.commit()
+
+
+def _firmas_publicadas() -> dict:
+    """Firma de los datos de entrenamiento de cada modelo publicado"""
+    db = SessionLocal()
+    try:
+        return dict(db.query(ModelMetadata.model_name, ModelMetadata.firma_datos).all())
+    finally:
+        db.close()
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    """Pool de procesos (spawn: no hereda conexiones de BD ni el event loop)"""
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(
+            max_workers=TRAINING_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker
+        )
+    return _executor
+
+
+def shutdown():
+    """Detiene el pool de procesos (llamar en el shutdown de FastAPI)"""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+def _update_job(job_id: str, **campos):
+    job = _jobs.get(job_id)
+    if job is None:
+        return
+    job.update(campos)
+    job["actualizado"] = datetime.utcnow()
+
+
+def get_job(job_id: str):
+    """Estado de un trabajo (None si no existe o ya se descartó)"""
+    return _jobs.get(job_id)
+
+
+def _new_job(tipo: str) -> dict:
+    """Registra un trabajo pendiente y descarta los terminados más viejos"""
+    job_id = uuid.uuid4().hex
+    ahora = datetime.utcnow()
+    _jobs[job_id] = {
+        "job_id": job_id,
+        "tipo": tipo,
+        "estado": "pendiente",
+        "etapa": None,
+        "progreso": 0,
+        "resultado": None,
+        "error": None,
+        "creado": ahora,
+        "actualizado": ahora
+    }
+
+    # Descartar trabajos viejos ya terminados (los pendientes o en curso se conservan)
+    sobrantes = len(_jobs) - MAX_JOBS_HISTORY
+    if sobrantes > 0:
+        terminados = [jid for jid, job in _jobs.items() if job["estado"] in _ESTADOS_FINALES]
+        for jid in terminados[:sobrantes]:
+            del _jobs[jid]
+
+    return _jobs[job_id]
+
+
+def _start(coro):
+    """Lanza la corrutina del trabajo en el event loop"""
+    task = asyncio.create_task(coro)
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+
+def _get_sync_lock() -> asyncio.Lock:
+    """Lock del sync (se crea dentro del event loop de la app)"""
+    global _sync_lock
+    if _sync_lock is None:
+        _sync_lock = asyncio.Lock()
+    return _sync_lock
+
+
+def submit_sync_job(full: bool = False) -> dict:
+    """
+    Encola un trabajo de sincronización + entrenamiento
+    Retorna de inmediato con el id del trabajo
+
+    Si ya hay un sync en curso se retorna ese trabajo en lugar de apilar otro.
+    Un sync completo pedido durante uno incremental se encola una sola vez
+    (los pedidos siguientes se unen a ese mismo trabajo encolado)
+    """
+    global _sync_actual, _sync_pendiente
+
+    pendiente = _jobs.get(_sync_pendiente) if _sync_pendiente else None
+    if pendiente is not None:
+        return pendiente
+
+    actual = _jobs.get(_sync_actual) if _sync_actual else None
+    if actual is not None and (not full or actual["tipo"] == "sync_completo"):
+        return actual
+
+    job = _new_job("sync_completo" if full else "sync")
+    if actual is None:
+        _sync_actual = job["job_id"]
+    else:
+        _sync_pendiente = job["job_id"]
+    _start(_run_sync_job(job["job_id"], full))
+    return job
+
+
+def submit_verify_job() -> dict:
+    """Encola la verificación de métricas de clientes contra ventas_cache"""
+    job = _new_job("verificacion_metricas")
+    _start(_run_verify_job(job["job_id"]))
+    return job
+
+
+def _refresh_models():
+    return model_registry.refresh(force=True)
+
+
+def _sync_reciente(desde: datetime) -> bool:
+    """Algún proceso terminó un sync después de `desde`"""
+    db = SessionLocal()
+    try:
+        ultimo = data_sync.ultimo_sync_terminado(db)
+        return ultimo is not None and ultimo >= desde
+    finally:
+        db.close()
+
+
+def _marcar_sync_terminado():
+    db = SessionLocal()
+    try:
+        data_sync.marcar_sync_terminado(db)
+    finally:
+        db.close()
+
+
+def _verify_in_thread():
+    db = SessionLocal()
+    try:
+        return data_sync.verify_cliente_metrics(db)
+    finally:
+        db.close()
+
+
+async def _run_verify_job(job_id: str):
+    """GROUP BY completo en un hilo: no bloquea el event loop"""
+    loop = asyncio.get_running_loop()
+    try:
+        # Las correcciones no deben mezclarse con las sumas de un sync de otro worker
+        async with sync_lock.adquirir():
+            _update_job(job_id, estado="en_progreso", etapa="verificacion")
+            resultado = await loop.run_in_executor(None, _verify_in_thread)
+        _update_job(job_id, estado="completado", etapa=None, progreso=100, resultado=resultado)
+        logger.info(f"✅ Trabajo {job_id} completado")
+    except Exception as e:
+        logger.error(f"❌ Error en trabajo {job_id}: {e}")
+        _update_job(job_id, estado="error", error=str(e))
+
+
+async def _run_sync_job(job_id: str, full: bool):
+    """
+    Espera su turno (un sync a la vez en este proceso y luego entre procesos)
+    y al terminar libera el lugar al encolado
+    """
+    global _sync_actual, _sync_pendiente
+    loop = asyncio.get_running_loop()
+    async with _get_sync_lock():
+        try:
+            async with sync_lock.adquirir():
+                creado = _jobs[job_id]["creado"] if job_id in _jobs else datetime.utcnow()
+                if not full and await loop.run_in_executor(None, _sync_reciente, creado):
+                    logger.info(f"⏭️ Trabajo {job_id}: otro proceso ya sincronizó, se omite")
+                    _update_job(job_id, estado="completado", etapa=None, progreso=100,
+                                resultado={"sync": None, "entrenamiento": {}, "omitido": "sync_reciente"})
+                    return
+                await _sync_and_train(job_id, full)
+        except Exception as e:
+            logger.error(f"❌ Error en trabajo {job_id}: {e}")
+            _update_job(job_id, estado="error", error=str(e))
+        finally:
+            if _sync_actual == job_id:
+                _sync_actual, _sync_pendiente = _sync_pendiente, None
+
+
+async def _sync_and_train(job_id: str, full: bool):
+    """
+    Ejecuta sync (I/O en el event loop) y luego cada entrenamiento en el pool
+    En modo incremental no se reentrena un modelo si sus datos de entrada no
+    cambiaron desde que se entrenó la versión publicada (en cualquier worker)
+    """
+    resultado = {"sync": None, "entrenamiento": {}}
+    loop = asyncio.get_running_loop()
+
+    try:
+        _update_job(job_id, estado="en_progreso", etapa="sync")
+
+        # Las ventas nuevas se puntúan al ingresar: usar el último detector publicado
+        # (lectura de BD y joblib.load en un hilo, no en el event loop)
+        await loop.run_in_executor(None, _refresh_models)
+
+        db = SessionLocal()
+        try:
+            resultado["sync"] = await data_sync.sync_data(db, full=full)
+            firmas = await loop.run_in_executor(None, data_sync.firma_datos, db)
+        finally:
+            db.close()
+        publicadas = await loop.run_in_executor(None, _firmas_publicadas)
+
+        # Conteos de /health al día sin esperar al próximo recálculo
+        await health.refresh()
+
+        for i, (nombre, _, _, fuente) in enumerate(_ENTRENAMIENTOS, start=1):
+            _update_job(job_id, etapa=nombre, progreso=int(100 * i / len(_ETAPAS)))
+
+            firma = json.dumps(firmas[fuente])
+            if not full and publicadas.get(nombre) == firma:
+                logger.info(f"⏭️ {nombre}: datos sin cambios, no se reentrena")
+                resultado["entrenamiento"][nombre] = {"modo": "sin_cambios"}
+                continue
+
+            resultado["entrenamiento"][nombre] = await loop.run_in_executor(
+                _get_executor(), _train_in_process, nombre, full, firma
+            )
+
+        # Cargar en este worker las versiones recién publicadas
+        # (los demás workers las detectan en su próxima verificación)
+        await loop.run_in_executor(None, _refresh_models)
+        await loop.run_in_executor(None, _marcar_sync_terminado)
+
+        _update_job(job_id, estado="completado", etapa=None, progreso=100, resultado=resultado)
+        logger.info(f"✅ Trabajo {job_id} completado")
+
+    except Exception as e:
+        logger.error(f"❌ Error en trabajo {job_id}: {e}")
+        _update_job(job_id, estado="error", resultado=resultado, error=str(e))
+        
+        # Un proceso de entrenamiento murió (p. ej. OOM): el pool queda inservible
+        if isinstance(e, BrokenProcessPool):
+            shutdown()
+
+
+async def _scheduler_loop():
+    while True:
+        await asyncio.sleep(SYNC_INTERVAL + random.uniform(0, SYNC_JITTER))
+        try:
+            job = submit_sync_job(full=False)
+            logger.info(f"⏰ Sync programado: trabajo {job['job_id']} ({job['estado']})")
+        except Exception as e:
+            logger.error(f"❌ Error lanzando sync programado: {e}")
+
+
+def start_scheduler():
+    """Lanza el sync incremental periódico (startup de FastAPI; SYNC_INTERVAL=0 lo desactiva)"""
+    global _scheduler_task
+    if SYNC_INTERVAL <= 0 or _scheduler_task is not None:
+        return
+    _scheduler_task = asyncio.create_task(_scheduler_loop())
+    logger.info(f"⏰ Sync programado cada {SYNC_INTERVAL:.0f}s (+ hasta {SYNC_JITTER:.0f}s de desfase)")
+
+
+async def stop_scheduler():
+    """Detiene el sync periódico (shutdown de FastAPI)"""
+    global _scheduler_task
+    if _scheduler_task is not None:
+        _scheduler_task.cancel()
+        try:
+            await _scheduler_task
+        except asyncio.CancelledError:
+            pass
+        _scheduler_task = None
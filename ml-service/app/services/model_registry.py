@@ -0,0 +1,80 @@
+"""
+Registro compartido de modelos entre workers de uvicorn
+La versión publicada vive en model_metadata y el artefacto en disco (model_store).
+Cada worker compara su versión en memoria con la publicada (consulta mínima,
+como mucho cada REGISTRY_CHECK_INTERVAL segundos) y recarga si cambió.
+Ningún worker entrena por su cuenta: solo recarga lo que otro publicó.
+"""
+from sqlalchemy.orm import Session
+import time
+import os
+import logging
+
+from app.database import ReadSessionLocal, ModelMetadata
+from app.services import model_store, predictor, segmentacion, anomalias
+
+logger = logging.getLogger(__name__)
+
+# Segundos entre verificaciones de versión por worker
+REGISTRY_CHECK_INTERVAL = float(os.getenv("REGISTRY_CHECK_INTERVAL", "2"))
+
+# Nombre del modelo -> caché en memoria del servicio que lo usa
+_MODEL_CACHES = {
+    "price_predictor": predictor._model_cache,
+    "customer_segmentation": segmentacion._model_cache,
+    "anomaly_detector": anomalias._model_cache,
+}
+
+_last_check = 0.0
+
+
+def _published_versions(db: Session) -> dict:
+    """Versión publicada de cada modelo"""
+    return dict(db.query(ModelMetadata.model_name, ModelMetadata.version).all())
+
+
+def refresh(db: Session = None, force: bool = False) -> list:
+    """
+    Recarga los modelos cuya versión publicada difiere de la cargada
+    Retorna los nombres de los modelos recargados
+    """
+    global _last_check
+    now = time.monotonic()
+    if not force and now - _last_check < REGISTRY_CHECK_INTERVAL:
+        return []
+    _last_check = now
+
+    own_session = db is None
+    db = db or ReadSessionLocal()
+    try:
+        versions = _published_versions(db)
+    finally:
+        if own_session:
+            db.close()
+
+    reloaded = []
+    for name, cache in _MODEL_CACHES.items():
+        version = versions.get(name)
+        if version and version != cache.get("version"):
+            if model_store.warm_load(name, cache, version):
+                reloaded.append(name)
+    return reloaded
+
+
+def load_all():
+    """
+    Carga inicial (startup): versión publicada o, si no hay registro, la última en disco
+    """
+    refresh(force=True)
+    for name, cache in _MODEL_CACHES.items():
+        if cache.get("model") is None:
+            model_store.warm_load(name, cache)
+
+
+def ensure_fresh():
+    """Dependency de FastAPI: recarga modelos publicados por otro worker"""
+    try:
+        refresh()
+    except Exception as e:
+        # Si falla la verificación se sigue con el modelo en memoria
+        logger.error(f"❌ Error verificando versiones de modelos: {e}")
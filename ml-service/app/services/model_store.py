@@ -0,0 +1,123 @@
+"""
+Almacén versionado de modelos entrenados (joblib en disco)
+Cada entrenamiento escribe models/<modelo>/v<N>.joblib; al arrancar se carga
+la última versión con arrays numpy memory-mapped, sin reentrenar
+"""
+import joblib
+import os
+import re
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Directorio de artefactos (en Docker: volumen ml-models en /app/models)
+MODELS_DIR = os.getenv("MODELS_DIR", "./models")
+# Versiones que se conservan por modelo
+MODEL_VERSIONS_KEEP = int(os.getenv("MODEL_VERSIONS_KEEP", "3"))
+
+_VERSION_RE = re.compile(r"^v(\d+)\.joblib$")
+
+# Lecturas y recargas de los cachés en memoria: un request nunca combina
+# piezas de dos versiones (p. ej. modelo nuevo con scaler viejo)
+_cache_lock = threading.Lock()
+
+
+def snapshot(model_cache: dict) -> dict:
+    """Copia consistente del caché en memoria (leer modelo, scaler, etc. desde aquí)"""
+    with _cache_lock:
+        return dict(model_cache)
+
+
+def replace(model_cache: dict, state: dict) -> None:
+    """Publica un estado completo en el caché en memoria de una sola vez"""
+    with _cache_lock:
+        model_cache.update(state)
+
+
+def _model_dir(name: str) -> str:
+    return os.path.join(MODELS_DIR, name)
+
+
+def _versions(name: str) -> list:
+    """Versiones disponibles de un modelo, de menor a mayor"""
+    path = _model_dir(name)
+    if not os.path.isdir(path):
+        return []
+    versions = []
+    for filename in os.listdir(path):
+        match = _VERSION_RE.match(filename)
+        if match:
+            versions.append(int(match.group(1)))
+    return sorted(versions)
+
+
+def latest_version(name: str):
+    """Última versión guardada (None si no hay artefactos)"""
+    versions = _versions(name)
+    return versions[-1] if versions else None
+
+
+def save_model(name: str, artifact: dict) -> int:
+    """
+    Guarda el artefacto como nueva versión y retorna su número
+    Se escribe a un archivo temporal propio del proceso y se publica con un hard
+    link, que falla si el vN ya existe: dos procesos nunca pisan la misma versión
+    ni quedan archivos a medias
+    """
+    os.makedirs(_model_dir(name), exist_ok=True)
+    tmp_path = os.path.join(_model_dir(name), f".tmp-{os.getpid()}-{threading.get_ident()}.joblib")
+
+    # Sin compresión: permite cargar los arrays con mmap_mode
+    joblib.dump(artifact, tmp_path)
+    try:
+        while True:
+            version = (latest_version(name) or 0) + 1
+            try:
+                os.link(tmp_path, os.path.join(_model_dir(name), f"v{version}.joblib"))
+                break
+            except FileExistsError:
+                continue
+    finally:
+        os.remove(tmp_path)
+
+    # Limpiar versiones viejas
+    for old in _versions(name)[:-MODEL_VERSIONS_KEEP]:
+        try:
+            os.remove(os.path.join(_model_dir(name), f"v{old}.joblib"))
+        except OSError:
+            pass
+
+    logger.info(f"💾 Modelo {name} guardado (v{version})")
+    return version
+
+
+def load_model(name: str, version: int = None):
+    """
+    Carga un artefacto (por defecto la última versión)
+    Retorna (version, artefacto) o (None, None) si no existe
+    """
+    version = version or latest_version(name)
+    if version is None:
+        return None, None
+
+    path = os.path.join(_model_dir(name), f"v{version}.joblib")
+    artifact = joblib.load(path, mmap_mode="r")
+    return version, artifact
+
+
+def warm_load(name: str, model_cache: dict, version: int = None) -> bool:
+    """Carga una versión (por defecto la última) en el caché en memoria del servicio"""
+    try:
+        version, artifact = load_model(name, version)
+    except Exception as e:
+        logger.error(f"❌ No se pudo cargar el modelo {name}: {e}")
+        return False
+
+    if artifact is None:
+        logger.info(f"ℹ️ Sin modelo guardado para {name} (ejecuta /sync)")
+        return False
+
+    replace(model_cache, {**artifact, "version": version})
+    logger.info(f"📦 Modelo {name} cargado desde disco (v{version})")
+    return True
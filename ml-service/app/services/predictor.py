@@ -4,20 +4,27 @@ Regresión Lineal simple con sklearn
 """
 from sklearn.linear_model import LinearRegression
 from sklearn.preprocessing import LabelEncoder
-import pandas as pd
+import numpy as np
 from sqlalchemy.orm import Session
-from app.database import ProductoCache, ModelMetadata
+from app.database import ModelMetadata
+from app.services import features, model_store
 from datetime import datetime
-import pickle
 import logging
+import os
 
 logger = logging.getLogger(__name__)
 
+# Máximo de productos por request en /predict/price/batch
+PREDICT_BATCH_MAX = int(os.getenv("PREDICT_BATCH_MAX", "50000"))
+
+FEATURES_USED = ["categoria", "stock", "longitud_nombre"]
+
 # Cache del modelo en memoria
 _model_cache = {
     "model": None,
     "label_encoder": None,
-    "trained_at": None
+    "trained_at": None,
+    "version": None
 }
 
 
@@ -29,44 +36,38 @@ def train_price_predictor(db: Session):
     """
     logger.info("🤖 Entrenando modelo de predicción de precios...")
     
-    # Obtener datos de productos
-    productos = db.query(ProductoCache).all()
+    # Obtener features de productos (solo las columnas necesarias)
+    df = features.load_productos(db)
     
-    if len(productos) < 10:
+    if len(df) < 10:
         logger.warning("⚠️ Pocos datos para entrenar (mínimo 10 productos)")
         return None
     
-    # Preparar dataset
-    data = []
-    for p in productos:
-        data.append({
-            "categoria": p.categoria,
-            "stock": p.stock,
-            "len_nombre": len(p.nombre),
-            "precio": p.precio
-        })
-    
-    df = pd.DataFrame(data)
-    
     # Encode categorías
     le = LabelEncoder()
     df["categoria_encoded"] = le.fit_transform(df["categoria"])
     
-    # Features y target
-    X = df[["categoria_encoded", "stock", "len_nombre"]]
-    y = df["precio"]
+    # Features y target (matriz numpy: se predice con el mismo formato)
+    X = df[["categoria_encoded", "stock", "len_nombre"]].to_numpy(dtype=float)
+    y = df["precio"].to_numpy(dtype=float)
     
     # Entrenar modelo
     model = LinearRegression()
     model.fit(X, y)
     
     # Calcular R² score como métrica simple
-    score = model.score(X, y)
+    score = float(model.score(X, y))
+    
+    artefacto = {
+        "model": model,
+        "label_encoder": le,
+        "trained_at": datetime.utcnow()
+    }
     
-    # Guardar en caché
-    _model_cache["model"] = model
-    _model_cache["label_encoder"] = le
-    _model_cache["trained_at"] = datetime.utcnow()
+    # Persistir artefacto versionado (lo cargan otros procesos y reinicios)
+    # y publicarlo en el caché en memoria
+    version = model_store.save_model("price_predictor", artefacto)
+    model_store.replace(_model_cache, {**artefacto, "version": version})
     
     # Guardar metadata
     metadata = db.query(ModelMetadata).filter_by(model_name="price_predictor").first()
@@ -75,22 +76,25 @@ def train_price_predictor(db: Session):
             model_name="price_predictor",
             trained_at=datetime.utcnow(),
             accuracy=score,
-            samples_count=len(productos),
+            samples_count=len(df),
             features='["categoria", "stock", "len_nombre"]'
         )
         db.add(metadata)
     else:
         metadata.trained_at = datetime.utcnow()
         metadata.accuracy = score
-        metadata.samples_count = len(productos)
+        metadata.samples_count = len(df)
+    
+    # Publicar la versión: los demás workers la detectan y recargan el artefacto
+    metadata.version = version
     
     db.commit()
     
-    logger.info(f"✅ Modelo entrenado - R²: {score:.4f} con {len(productos)} productos")
+    logger.info(f"✅ Modelo entrenado - R²: {score:.4f} con {len(df)} productos")
     
     return {
         "accuracy": score,
-        "samples": len(productos)
+        "samples": len(df)
     }
 
 
@@ -98,35 +102,63 @@ def predict_price(categoria: str, stock: int, nombre: str):
     """
     Predice el precio de un producto
     """
+    return predict_price_batch([
+        {"categoria": categoria, "stock": stock, "nombre": nombre}
+    ])[0]
+
+
+def _encode_categorias(le: LabelEncoder, categorias: np.ndarray) -> np.ndarray:
+    """
+    Codifica categorías de forma vectorizada con el LabelEncoder entrenado
+    Categorías desconocidas usan el código central (promedio)
+    """
+    classes = le.classes_
+    idx = np.searchsorted(classes, categorias)
+    idx = np.clip(idx, 0, len(classes) - 1)
+    conocidas = classes[idx] == categorias
+    return np.where(conocidas, idx, len(classes) // 2)
+
+
+def predict_price_batch(productos: list):
+    """
+    Predice el precio de muchos productos con una sola llamada a model.predict
+    productos: lista de dicts con categoria, stock y nombre
+    Retorna las predicciones en el mismo orden
+    """
     if _model_cache["model"] is None:
         raise ValueError("Modelo no entrenado. Ejecuta /sync primero.")
     
-    model = _model_cache["model"]
-    le = _model_cache["label_encoder"]
+    if len(productos) > PREDICT_BATCH_MAX:
+        raise ValueError(f"Máximo {PREDICT_BATCH_MAX} productos por request")
     
-    # Encode categoria (si no existe, usar categoría más frecuente)
-    try:
-        categoria_encoded = le.transform([categoria])[0]
-    except ValueError:
-        # Categoría desconocida, usar promedio
-        categoria_encoded = len(le.classes_) // 2
+    if not productos:
+        return []
     
-    len_nombre = len(nombre)
+    modelo = model_store.snapshot(_model_cache)
+    model = modelo["model"]
+    le = modelo["label_encoder"]
+    
+    categorias = np.array([p["categoria"] for p in productos], dtype=object)
+    stock = np.array([p["stock"] for p in productos], dtype=float)
+    len_nombre = np.array([len(p["nombre"]) for p in productos], dtype=float)
     
     # Predecir
-    X_new = [[categoria_encoded, stock, len_nombre]]
-    precio_pred = model.predict(X_new)[0]
+    X_new = np.column_stack([_encode_categorias(le, categorias), stock, len_nombre])
+    precios = np.round(model.predict(X_new), 2)
     
     # Confianza simple (basada en R² del modelo)
     # En producción usarías cross-validation
     confianza = 0.85  # placeholder
     
-    return {
-        "precio_sugerido": round(float(precio_pred), 2),
-        "categoria": categoria,
-        "confianza": confianza,
-        "features_used": ["categoria", "stock", "longitud_nombre"]
-    }
+    return [
+        {
+            "precio_sugerido": float(precio),
+            "categoria": categoria,
+            "confianza": confianza,
+            "features_used": FEATURES_USED
+        }
+        for precio, categoria in zip(precios, categorias)
+    ]
 
 
 def get_model_info(db: Session):
@@ -139,6 +171,7 @@ def get_model_info(db: Session):
             "trained_at": metadata.trained_at,
             "accuracy": metadata.accuracy,
             "samples_count": metadata.samples_count,
+            "version": metadata.version,
             "features": ["categoria", "stock", "len_nombre"]
         }
     
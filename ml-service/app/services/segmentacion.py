@@ -2,115 +2,292 @@
 Servicio de segmentación de clientes (ML No Supervisado)
 K-Means clustering con sklearn
 """
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, MiniBatchKMeans
 from sklearn.preprocessing import StandardScaler
-import pandas as pd
+import numpy as np
+from sqlalchemy import func, tuple_, update
 from sqlalchemy.orm import Session
 from app.database import ClienteMetrics, ModelMetadata
+from app.services import features, model_store
 from datetime import datetime
+import base64
+import copy
+import json
 import logging
+import os
 
 logger = logging.getLogger(__name__)
 
+# Motor de segmentación: kmeans (reentrena todo en cada sync) o minibatch
+# (MiniBatchKMeans con actualización incremental de centroides)
+SEGMENTATION_ENGINE = os.getenv("SEGMENTATION_ENGINE", "kmeans")
+SEGMENTATION_BATCH_SIZE = int(os.getenv("SEGMENTATION_BATCH_SIZE", "1024"))
+# Fracción de clientes cambiados a partir de la cual se reentrena completo
+SEGMENTATION_REFIT_RATIO = float(os.getenv("SEGMENTATION_REFIT_RATIO", "0.5"))
+# Aumento relativo de la distancia media al centroide a partir del cual se reentrena
+SEGMENTATION_DRIFT_THRESHOLD = float(os.getenv("SEGMENTATION_DRIFT_THRESHOLD", "0.15"))
+# Máximo de clientes por request en /ml/segmentacion/cliente/batch
+SEGMENT_BATCH_MAX = int(os.getenv("SEGMENT_BATCH_MAX", "10000"))
+
+SEGMENTOS = ["VIP", "Regular", "Ocasional", "Sin clasificar"]
+
+# Columnas por las que se puede ordenar /ml/segmentacion
+_SORT_COLUMNS = {
+    "cliente_id": ClienteMetrics.cliente_id,
+    "total_compras": ClienteMetrics.total_compras,
+    "frecuencia": ClienteMetrics.frecuencia,
+    "ticket_promedio": ClienteMetrics.ticket_promedio,
+}
+
 # Cache del modelo
 _model_cache = {
     "model": None,
     "scaler": None,
-    "trained_at": None
+    "cluster_map": None,  # índice de cluster -> segmento
+    "inercia_media": None,  # distancia² media al centroide al entrenar (referencia de drift)
+    "trained_at": None,
+    "version": None
 }
 
 
-def train_segmentation(db: Session):
+def _fit_model(X_scaled, engine: str = None):
+    """Entrenamiento completo: KMeans (por defecto) o MiniBatchKMeans"""
+    engine = engine or SEGMENTATION_ENGINE
+    if engine == "minibatch":
+        model = MiniBatchKMeans(
+            n_clusters=3,
+            random_state=42,
+            batch_size=SEGMENTATION_BATCH_SIZE,
+            n_init=3
+        )
+    else:
+        model = KMeans(n_clusters=3, random_state=42, n_init=10)
+    model.fit(X_scaled)
+    return model
+
+
+def _partial_update(model, X_scaled) -> None:
+    """Mueve los centroides con las métricas nuevas (partial_fit por lotes)"""
+    for i in range(0, len(X_scaled), SEGMENTATION_BATCH_SIZE):
+        model.partial_fit(X_scaled[i:i + SEGMENTATION_BATCH_SIZE])
+
+
+def _cluster_map(model, scaler) -> dict:
     """
-    Entrena modelo de clustering K-Means
-    Features: total_compras, frecuencia, ticket_promedio
-    3 clusters: VIP, Regular, Ocasional
+    Mapea clusters a segmentos interpretables
+    Centroide con mayor ticket promedio = VIP, luego Regular y Ocasional
     """
-    logger.info("🎯 Entrenando modelo de segmentación de clientes...")
+    centroides = scaler.inverse_transform(model.cluster_centers_)
+    ticket = centroides[:, features.CLIENTE_FEATURES.index("ticket_promedio")]
+    orden = np.argsort(-ticket)
+    return {int(cluster): segmento for cluster, segmento in zip(orden, ["VIP", "Regular", "Ocasional"])}
+
+
+def _distancias(X_scaled, centroides):
+    """Distancia² de cada fila a cada centroide (n x clusters)"""
+    return ((X_scaled[:, None, :] - centroides[None, :, :]) ** 2).sum(axis=2)
+
+
+def _inercia_media(X_scaled, centroides) -> float:
+    """Distancia² media al centroide más cercano"""
+    return float(_distancias(X_scaled, centroides).min(axis=1).mean())
+
+
+def _guardar_segmentos(db: Session, df) -> None:
+    """Actualiza segmentos en BD (un UPDATE por lotes con executemany, por id)"""
+    if df.empty:
+        return
+    db.execute(update(ClienteMetrics), df[["id", "segmento"]].to_dict("records"))
+
+
+def _publicar(db: Session, model, scaler, cluster_map: dict, inercia_media: float,
+              trained_at: datetime, samples: int) -> None:
+    """Guarda el modelo en caché, en disco (nueva versión) y en model_metadata"""
+    artefacto = {
+        "model": model,
+        "scaler": scaler,
+        "cluster_map": cluster_map,
+        "inercia_media": inercia_media,
+        "trained_at": trained_at
+    }
     
-    # Obtener métricas de clientes
-    clientes = db.query(ClienteMetrics).all()
+    # Persistir artefacto versionado (lo cargan otros procesos y reinicios)
+    # y publicarlo en el caché en memoria
+    version = model_store.save_model("customer_segmentation", artefacto)
+    model_store.replace(_model_cache, {**artefacto, "version": version})
     
-    if len(clientes) < 5:
-        logger.warning("⚠️ Pocos clientes para clustering (mínimo 5)")
-        return None
+    # Guardar metadata
+    metadata = db.query(ModelMetadata).filter_by(model_name="customer_segmentation").first()
+    if not metadata:
+        metadata = ModelMetadata(
+            model_name="customer_segmentation",
+            trained_at=datetime.utcnow(),
+            accuracy=None,  # clustering no tiene accuracy tradicional
+            samples_count=samples,
+            features='["total_compras", "frecuencia", "ticket_promedio"]'
+        )
+        db.add(metadata)
+    else:
+        metadata.trained_at = datetime.utcnow()
+        metadata.samples_count = samples
     
-    # Preparar dataset
-    data = []
-    for c in clientes:
-        data.append({
-            "cliente_id": c.cliente_id,
-            "total_compras": c.total_compras,
-            "frecuencia": c.frecuencia,
-            "ticket_promedio": c.ticket_promedio
-        })
+    # Publicar la versión: los demás workers la detectan y recargan el artefacto
+    metadata.version = version
     
-    df = pd.DataFrame(data)
+    db.commit()
+
+
+def _train_full(db: Session, inicio: datetime):
+    """Reentrenamiento completo sobre todos los clientes"""
+    # Obtener métricas de clientes (solo las columnas necesarias)
+    df = features.load_clientes(db)
+    
+    if len(df) < 5:
+        logger.warning("⚠️ Pocos clientes para clustering (mínimo 5)")
+        return None
     
     # Features para clustering
-    X = df[["total_compras", "frecuencia", "ticket_promedio"]]
+    X = df[features.CLIENTE_FEATURES].to_numpy(dtype=float)
     
     # Escalar features
     scaler = StandardScaler()
     X_scaled = scaler.fit_transform(X)
     
-    # Entrenar K-Means (3 clusters)
-    kmeans = KMeans(n_clusters=3, random_state=42, n_init=10)
-    kmeans.fit(X_scaled)
+    # Entrenar (3 clusters)
+    model = _fit_model(X_scaled)
+    cluster_map = _cluster_map(model, scaler)
     
-    # Asignar etiquetas
-    df["cluster"] = kmeans.labels_
+    # Asignar segmentos
+    df["segmento"] = [cluster_map[int(c)] for c in model.labels_]
+    _guardar_segmentos(db, df)
+    db.commit()
     
-    # Mapear clusters a segmentos interpretables
-    # Cluster con mayor ticket promedio = VIP
-    cluster_means = df.groupby("cluster")["ticket_promedio"].mean()
-    sorted_clusters = cluster_means.sort_values(ascending=False).index.tolist()
+    _publicar(db, model, scaler, cluster_map, _inercia_media(X_scaled, model.cluster_centers_), inicio, len(df))
+    return "completo"
+
+
+def _train_incremental(db: Session, inicio: datetime):
+    """
+    Actualiza los centroides solo con los clientes cuyas métricas cambiaron
+    desde el último entrenamiento. Retorna None si hace falta un reentrenamiento
+    completo (sin modelo incremental previo, demasiados cambios o mapeo inestable)
+    """
+    previo = model_store.snapshot(_model_cache)
+    if not isinstance(previo["model"], MiniBatchKMeans) or not previo.get("cluster_map"):
+        logger.info("ℹ️ Sin modelo incremental previo: reentrenamiento completo")
+        return None
     
-    cluster_map = {
-        sorted_clusters[0]: "VIP",
-        sorted_clusters[1]: "Regular",
-        sorted_clusters[2]: "Ocasional"
-    }
+    # Copia escribible (el artefacto se carga con arrays memory-mapped de solo lectura)
+    model = copy.deepcopy(previo["model"])
+    scaler = previo["scaler"]
+    cluster_map = previo["cluster_map"]
     
-    df["segmento"] = df["cluster"].map(cluster_map)
+    total = db.query(func.count(ClienteMetrics.id)).scalar()
+    df = features.load_clientes(db, ClienteMetrics.updated_at > previo["trained_at"])
     
-    # Actualizar segmentos en BD
-    for _, row in df.iterrows():
-        cliente = db.query(ClienteMetrics).filter_by(cliente_id=int(row["cliente_id"])).first()
-        if cliente:
-            cliente.segmento = row["segmento"]
-            cliente.updated_at = datetime.utcnow()
+    if len(df) > SEGMENTATION_REFIT_RATIO * total:
+        logger.info(f"ℹ️ {len(df)} de {total} clientes cambiaron: reentrenamiento completo")
+        return None
     
-    db.commit()
+    if df.empty:
+        logger.info("ℹ️ Sin clientes nuevos o actualizados: se mantiene el modelo")
+        return "sin_cambios"
     
-    # Guardar en caché
-    _model_cache["model"] = kmeans
-    _model_cache["scaler"] = scaler
-    _model_cache["trained_at"] = datetime.utcnow()
+    # El scaler queda fijo: los centroides siguen siendo comparables entre versiones
+    X_scaled = scaler.transform(df[features.CLIENTE_FEATURES].to_numpy(dtype=float))
+    _partial_update(model, X_scaled)
     
-    # Guardar metadata
-    metadata = db.query(ModelMetadata).filter_by(model_name="customer_segmentation").first()
-    if not metadata:
-        metadata = ModelMetadata(
-            model_name="customer_segmentation",
-            trained_at=datetime.utcnow(),
-            accuracy=None,  # clustering no tiene accuracy tradicional
-            samples_count=len(clientes),
-            features='["total_compras", "frecuencia", "ticket_promedio"]'
-        )
-        db.add(metadata)
-    else:
-        metadata.trained_at = datetime.utcnow()
-        metadata.samples_count = len(clientes)
+    # Los índices de cluster se conservan; si los centroides se cruzaron
+    # el mapeo ya no es válido
+    if _cluster_map(model, scaler) != cluster_map:
+        logger.info("ℹ️ Los centroides cambiaron de orden: reentrenamiento completo")
+        return None
     
+    df["segmento"] = [cluster_map[int(c)] for c in model.predict(X_scaled)]
+    _guardar_segmentos(db, df)
     db.commit()
     
+    logger.info(f"🔁 Centroides actualizados con {len(df)} clientes")
+    # La referencia de drift sigue siendo la del último entrenamiento completo
+    _publicar(db, model, scaler, cluster_map, previo["inercia_media"], inicio, total)
+    return "incremental"
+
+
+def medir_drift(db: Session):
+    """
+    Drift del modelo: aumento relativo de la distancia² media de los clientes
+    actuales a su centroide, respecto a la del entrenamiento
+    Retorna None si no hay modelo (o el artefacto no tiene referencia)
+    """
+    modelo = model_store.snapshot(_model_cache)
+    if modelo["model"] is None or not modelo.get("inercia_media"):
+        return None
+    
+    df = features.load_clientes(db)
+    if df.empty:
+        return None
+    
+    scaler = modelo["scaler"]
+    X_scaled = (df[features.CLIENTE_FEATURES].to_numpy(dtype=float) - scaler.mean_) / scaler.scale_
+    inercia = _inercia_media(X_scaled, modelo["model"].cluster_centers_)
+    return inercia / modelo["inercia_media"] - 1
+
+
+def _cargar_publicado(db: Session) -> None:
+    """Carga en el caché la versión publicada en model_metadata (o la última en disco)"""
+    version = db.query(ModelMetadata.version).filter_by(model_name="customer_segmentation").scalar()
+    if version is None:
+        if _model_cache["model"] is None:
+            model_store.warm_load("customer_segmentation", _model_cache)
+    elif version != _model_cache.get("version"):
+        model_store.warm_load("customer_segmentation", _model_cache, version)
+
+
+def train_segmentation(db: Session, full: bool = False):
+    """
+    Entrena modelo de clustering (K-Means o MiniBatchKMeans)
+    Features: total_compras, frecuencia, ticket_promedio
+    3 clusters: VIP, Regular, Ocasional
+    
+    Con SEGMENTATION_ENGINE=minibatch, en cada corrida se actualizan los centroides
+    solo con los clientes que cambiaron (partial_fit). Con kmeans el modelo se
+    mantiene mientras el drift no supere SEGMENTATION_DRIFT_THRESHOLD (el sync ya
+    asigna los segmentos con el modelo vigente). Un drift sobre el umbral o
+    full=True fuerzan el reentrenamiento completo
+    """
+    logger.info("🎯 Entrenando modelo de segmentación de clientes...")
+    
+    # Marca de los datos usados: lo que cambie después entra en la próxima actualización
+    inicio = datetime.utcnow()
+    
+    # El proceso de entrenamiento vive entre corridas: partir siempre de la versión
+    # publicada (otro worker pudo publicar una más nueva desde la última carga)
+    _cargar_publicado(db)
+    
+    drift = None if full else medir_drift(db)
+    
+    modo = None
+    if full:
+        pass
+    elif drift is not None and drift >= SEGMENTATION_DRIFT_THRESHOLD:
+        logger.info(f"ℹ️ Drift {drift:.3f} sobre el umbral: reentrenamiento completo")
+    elif SEGMENTATION_ENGINE == "minibatch":
+        modo = _train_incremental(db, inicio)
+    elif drift is not None:
+        logger.info(f"ℹ️ Drift {drift:.3f} bajo el umbral: se mantiene el modelo")
+        modo = "sin_drift"
+    if modo is None:
+        modo = _train_full(db, inicio)
+    if modo is None:
+        return None
+    
     # Stats
-    vip_count = sum(df["segmento"] == "VIP")
-    regular_count = sum(df["segmento"] == "Regular")
-    ocasional_count = sum(df["segmento"] == "Ocasional")
+    counts = _segment_counts(db)
+    vip_count = counts.get("VIP", 0)
+    regular_count = counts.get("Regular", 0)
+    ocasional_count = counts.get("Ocasional", 0)
     
-    logger.info(f"✅ Segmentación completada:")
+    logger.info(f"✅ Segmentación completada ({modo}):")
     logger.info(f"   - VIP: {vip_count}")
     logger.info(f"   - Regulares: {regular_count}")
     logger.info(f"   - Ocasionales: {ocasional_count}")
@@ -118,40 +295,173 @@ def train_segmentation(db: Session):
     return {
         "vip_count": vip_count,
         "regular_count": regular_count,
-        "ocasional_count": ocasional_count
+        "ocasional_count": ocasional_count,
+        "modo": modo,
+        "drift": drift
     }
 
 
-def get_segmentation(db: Session):
+def asignar_segmentos(X) -> list:
+    """
+    Segmento por centroide más cercano (equivale a model.predict)
+    Cálculo directo con numpy: sin la validación de sklearn en cada llamada
+    """
+    modelo = model_store.snapshot(_model_cache)
+    model = modelo["model"]
+    scaler = modelo["scaler"]
+    cluster_map = modelo.get("cluster_map") or _cluster_map(model, scaler)
+    
+    X_scaled = (X - scaler.mean_) / scaler.scale_
+    clusters = _distancias(X_scaled, model.cluster_centers_).argmin(axis=1)
+    return [cluster_map[int(c)] for c in clusters]
+
+
+def segment_clientes(db: Session, cliente_ids: list):
     """
-    Obtiene la segmentación actual de todos los clientes
+    Segmento de clientes puntuales con el scaler y los centroides en memoria
+    Retorna (clientes encontrados, ids sin métricas), en el orden del request
     """
-    clientes = db.query(ClienteMetrics).all()
+    if _model_cache["model"] is None:
+        raise ValueError("Modelo no entrenado. Ejecuta /sync primero.")
+    
+    if len(cliente_ids) > SEGMENT_BATCH_MAX:
+        raise ValueError(f"Máximo {SEGMENT_BATCH_MAX} clientes por request")
+    
+    if not cliente_ids:
+        return [], []
+    
+    rows = db.query(
+        ClienteMetrics.cliente_id,
+        ClienteMetrics.nombre,
+        ClienteMetrics.total_compras,
+        ClienteMetrics.frecuencia,
+        ClienteMetrics.ticket_promedio
+    ).filter(ClienteMetrics.cliente_id.in_(set(cliente_ids))).all()
+    por_id = {r.cliente_id: r for r in rows}
+    
+    encontrados = [por_id[cid] for cid in cliente_ids if cid in por_id]
+    no_encontrados = [cid for cid in cliente_ids if cid not in por_id]
+    
+    if not encontrados:
+        return [], no_encontrados
+    
+    X = np.array(
+        [[getattr(r, f) for f in features.CLIENTE_FEATURES] for r in encontrados],
+        dtype=float
+    )
+    segmentos = asignar_segmentos(X)
+    
+    clientes = [
+        {
+            "cliente_id": r.cliente_id,
+            "nombre": r.nombre,
+            "segmento": segmento,
+            "total_compras": r.total_compras,
+            "frecuencia": r.frecuencia,
+            "ticket_promedio": r.ticket_promedio
+        }
+        for r, segmento in zip(encontrados, segmentos)
+    ]
+    return clientes, no_encontrados
+
+
+def _encode_cursor(valor, cliente_id: int) -> str:
+    """Cursor opaco con la última posición (valor de orden, cliente_id)"""
+    return base64.urlsafe_b64encode(json.dumps([valor, cliente_id]).encode()).decode()
+
+
+def _decode_cursor(cursor: str):
+    try:
+        valor, cliente_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return valor, int(cliente_id)
+    except (ValueError, TypeError):
+        raise ValueError("Cursor inválido")
+
+
+def _segment_counts(db: Session) -> dict:
+    """Clientes por segmento con un GROUP BY"""
+    return dict(
+        db.query(ClienteMetrics.segmento, func.count(ClienteMetrics.id))
+        .group_by(ClienteMetrics.segmento)
+        .all()
+    )
+
+
+def get_segmentation(db: Session, segmento: str = None, limit: int = None,
+                     cursor: str = None, sort: str = "cliente_id", resumen: bool = False):
+    """
+    Obtiene la segmentación actual de los clientes
+    
+    segmento: solo clientes de ese segmento (VIP, Regular, Ocasional, Sin clasificar)
+    limit/cursor: paginación por keyset (next_cursor apunta a la siguiente página)
+    sort: cliente_id, total_compras, frecuencia o ticket_promedio ("-" = descendente)
+    resumen: solo los conteos, sin la lista de clientes
+    """
+    if segmento is not None and segmento not in SEGMENTOS:
+        raise ValueError(f"Segmento inválido: {segmento} (opciones: {', '.join(SEGMENTOS)})")
+    
+    descendente = sort.startswith("-")
+    campo = sort.lstrip("-")
+    if campo not in _SORT_COLUMNS:
+        raise ValueError(f"Orden inválido: {sort} (opciones: {', '.join(_SORT_COLUMNS)})")
+    
+    counts = _segment_counts(db)
     
     result = {
-        "total_clientes": len(clientes),
-        "vip_count": 0,
-        "regular_count": 0,
-        "ocasional_count": 0,
-        "clientes": []
+        "total_clientes": sum(counts.values()),
+        "vip_count": counts.get("VIP", 0),
+        "regular_count": counts.get("Regular", 0),
+        "ocasional_count": counts.get("Ocasional", 0),
+        "clientes": [],
+        "next_cursor": None
     }
     
-    for c in clientes:
-        if c.segmento == "VIP":
-            result["vip_count"] += 1
-        elif c.segmento == "Regular":
-            result["regular_count"] += 1
-        elif c.segmento == "Ocasional":
-            result["ocasional_count"] += 1
-        
-        result["clientes"].append({
+    if resumen:
+        return result
+    
+    columna = _SORT_COLUMNS[campo]
+    query = db.query(
+        ClienteMetrics.cliente_id,
+        ClienteMetrics.nombre,
+        ClienteMetrics.segmento,
+        ClienteMetrics.total_compras,
+        ClienteMetrics.frecuencia,
+        ClienteMetrics.ticket_promedio
+    )
+    
+    if segmento == "Sin clasificar":
+        query = query.filter(ClienteMetrics.segmento.is_(None))
+    elif segmento:
+        query = query.filter(ClienteMetrics.segmento == segmento)
+    
+    # Orden (columna, cliente_id): estable aunque haya valores repetidos
+    orden = [columna] if campo == "cliente_id" else [columna, ClienteMetrics.cliente_id]
+    if cursor:
+        valor, ultimo_id = _decode_cursor(cursor)
+        posicion = ultimo_id if campo == "cliente_id" else tuple_(valor, ultimo_id)
+        clave = orden[0] if campo == "cliente_id" else tuple_(*orden)
+        query = query.filter(clave < posicion if descendente else clave > posicion)
+    
+    query = query.order_by(*[c.desc() if descendente else c.asc() for c in orden])
+    
+    # Una fila extra indica si hay otra página
+    rows = query.limit(limit + 1).all() if limit else query.all()
+    if limit and len(rows) > limit:
+        rows = rows[:limit]
+        ultimo = rows[-1]
+        result["next_cursor"] = _encode_cursor(getattr(ultimo, campo), ultimo.cliente_id)
+    
+    result["clientes"] = [
+        {
             "cliente_id": c.cliente_id,
             "nombre": c.nombre,
             "segmento": c.segmento or "Sin clasificar",
             "total_compras": c.total_compras,
             "frecuencia": c.frecuencia,
             "ticket_promedio": c.ticket_promedio
-        })
+        }
+        for c in rows
+    ]
     
     return result
 
@@ -166,6 +476,7 @@ def get_model_info(db: Session):
             "trained_at": metadata.trained_at,
             "accuracy": None,
             "samples_count": metadata.samples_count,
+            "version": metadata.version,
             "features": ["total_compras", "frecuencia", "ticket_promedio"]
         }
     
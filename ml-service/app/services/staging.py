@@ -0,0 +1,110 @@
+"""
+Carga en tablas de staging y swap atómico (sync completo)
+El sync completo escribe en un esquema aparte con las mismas tablas; al terminar
+las tablas vivas se reemplazan en una sola transacción, así las lecturas
+concurrentes ven el snapshot anterior completo o el nuevo completo (nunca vacío)
+- SQLite: base adjunta (ATTACH) + DELETE / INSERT ... SELECT en una transacción
+- PostgreSQL: esquema propio + ALTER TABLE ... SET SCHEMA (solo metadata)
+"""
+from contextlib import contextmanager
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+import os
+import logging
+
+from app.database import engine, Base, ProductoCache, VentaCache, ClienteCache, ClienteMetrics, SyncState
+
+logger = logging.getLogger(__name__)
+
+STAGING_SCHEMA = "ml_staging"
+_OLD_SCHEMA = "ml_old"
+
+# Tablas que reconstruye el sync completo (se reemplazan juntas)
+_TABLAS = [t.__table__ for t in (ProductoCache, VentaCache, ClienteCache, ClienteMetrics, SyncState)]
+
+
+def _sqlite_staging_path() -> str:
+    """Archivo de la base adjunta (junto a la base principal)"""
+    database = engine.url.database
+    if not database or database == ":memory:":
+        return ":memory:"
+    return f"{database}.staging"
+
+
+def _preparar(conn) -> None:
+    """Crea el esquema de staging vacío (descarta restos de un sync interrumpido)"""
+    if engine.dialect.name == "postgresql":
+        conn.execute(text(f"DROP SCHEMA IF EXISTS {STAGING_SCHEMA} CASCADE"))
+        conn.execute(text(f"CREATE SCHEMA {STAGING_SCHEMA}"))
+    else:
+        path = _sqlite_staging_path()
+        if path != ":memory:" and os.path.exists(path):
+            os.remove(path)
+        conn.exec_driver_sql(f"ATTACH DATABASE ? AS {STAGING_SCHEMA}", (path,))
+
+
+def _limpiar(conn) -> None:
+    if engine.dialect.name == "postgresql":
+        conn.execute(text(f"DROP SCHEMA IF EXISTS {STAGING_SCHEMA} CASCADE"))
+        conn.commit()
+    else:
+        conn.exec_driver_sql(f"DETACH DATABASE {STAGING_SCHEMA}")
+        path = _sqlite_staging_path()
+        if path != ":memory:" and os.path.exists(path):
+            os.remove(path)
+
+
+@contextmanager
+def staging_session():
+    """
+    Sesión cuyas tablas apuntan al esquema de staging (vacío)
+    Todo lo que el sync escribe con esta sesión queda fuera de las tablas vivas
+    hasta llamar a swap()
+    """
+    conn = engine.connect()
+    try:
+        conn.rollback()
+        _preparar(conn)
+        staged = conn.execution_options(schema_translate_map={None: STAGING_SCHEMA})
+        Base.metadata.create_all(staged, tables=_TABLAS)
+        conn.commit()
+
+        db = Session(bind=staged)
+        try:
+            yield db
+        finally:
+            db.close()
+    finally:
+        try:
+            conn.rollback()
+            _limpiar(conn)
+        except Exception as e:
+            logger.error(f"❌ Error limpiando staging: {e}")
+        conn.close()
+
+
+def swap(db: Session) -> None:
+    """Reemplaza las tablas vivas por las de staging en una sola transacción"""
+    db.commit()
+
+    if engine.dialect.name == "postgresql":
+        # Mover tablas entre esquemas: índices, constraints y secuencias van con ellas
+        vivo = db.execute(text("SELECT current_schema()")).scalar()
+        db.execute(text(f"DROP SCHEMA IF EXISTS {_OLD_SCHEMA} CASCADE"))
+        db.execute(text(f"CREATE SCHEMA {_OLD_SCHEMA}"))
+        for table in _TABLAS:
+            db.execute(text(f"ALTER TABLE {vivo}.{table.name} SET SCHEMA {_OLD_SCHEMA}"))
+            db.execute(text(f"ALTER TABLE {STAGING_SCHEMA}.{table.name} SET SCHEMA {vivo}"))
+        db.execute(text(f"DROP SCHEMA {_OLD_SCHEMA} CASCADE"))
+    else:
+        # SQLite no mueve tablas entre bases: se copia dentro de la misma transacción
+        for table in _TABLAS:
+            cols = ", ".join(c.name for c in table.columns)
+            db.execute(text(f"DELETE FROM main.{table.name}"))
+            db.execute(text(
+                f"INSERT INTO main.{table.name} ({cols}) "
+                f"SELECT {cols} FROM {STAGING_SCHEMA}.{table.name}"
+            ))
+
+    db.commit()
+    logger.info("🔀 Caché reemplazada por el nuevo snapshot")
@@ -0,0 +1,101 @@
+"""
+Lock de sync entre procesos
+Con varios workers (uvicorn --workers N) o instancias, cada uno tiene su propia
+cola de trabajos y su propio scheduler; este lock asegura que un solo sync,
+entrenamiento o verificación escriba la caché y los modelos a la vez
+- SQLite: flock sobre un archivo junto a la base (procesos del mismo nodo)
+- PostgreSQL: advisory lock de sesión (cualquier nodo que comparta la base)
+"""
+from contextlib import asynccontextmanager
+from sqlalchemy import text
+import tempfile
+import asyncio
+import fcntl
+import os
+import logging
+
+from app.database import engine
+
+logger = logging.getLogger(__name__)
+
+# Segundos entre intentos mientras otro proceso tiene el lock
+SYNC_LOCK_POLL = float(os.getenv("SYNC_LOCK_POLL", "1"))
+
+# Clave del advisory lock en PostgreSQL (compartida por todos los procesos)
+_ADVISORY_KEY = 0x6D6C73796E63  # "mlsync"
+
+
+def _lock_path() -> str:
+    """Archivo del lock (junto a la base principal)"""
+    database = engine.url.database
+    if not database or database == ":memory:":
+        return os.path.join(tempfile.gettempdir(), "ml-service.sync.lock")
+    return f"{database}.sync.lock"
+
+
+def _intentar_postgres():
+    conn = engine.connect()
+    try:
+        tomado = conn.execute(text("SELECT pg_try_advisory_lock(:k)"), {"k": _ADVISORY_KEY}).scalar()
+        # El lock es de sesión: no dejar la conexión "idle in transaction" mientras dura
+        conn.commit()
+    except Exception:
+        conn.close()
+        raise
+    if not tomado:
+        conn.close()
+        return None
+
+    def liberar():
+        try:
+            conn.execute(text("SELECT pg_advisory_unlock(:k)"), {"k": _ADVISORY_KEY})
+            conn.commit()
+        finally:
+            conn.close()
+
+    return liberar
+
+
+def _intentar_archivo():
+    fd = os.open(_lock_path(), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+
+    def liberar():
+        try:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+    return liberar
+
+
+def _intentar():
+    """Intenta tomar el lock sin esperar; retorna la función que lo libera o None"""
+    if engine.dialect.name == "postgresql":
+        return _intentar_postgres()
+    return _intentar_archivo()
+
+
+@asynccontextmanager
+async def adquirir():
+    """
+    Espera el lock sin bloquear el event loop (reintenta cada SYNC_LOCK_POLL)
+    Entrega True si tuvo que esperar a otro proceso
+    """
+    loop = asyncio.get_running_loop()
+    liberar = await loop.run_in_executor(None, _intentar)
+    espero = False
+    while liberar is None:
+        if not espero:
+            logger.info("⏳ Otro proceso está sincronizando, esperando su fin")
+            espero = True
+        await asyncio.sleep(SYNC_LOCK_POLL)
+        liberar = await loop.run_in_executor(None, _intentar)
+    try:
+        yield espero
+    finally:
+        await loop.run_in_executor(None, liberar)
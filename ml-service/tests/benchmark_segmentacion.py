@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Benchmark del motor de segmentación
+Compara KMeans completo contra MiniBatchKMeans (completo e incremental con
+partial_fit) en tiempo de entrenamiento y concordancia de segmentos asignados
+
+Uso:
+    python3 tests/benchmark_segmentacion.py [--clientes 200000] [--nuevos 0.05]
+
+No requiere core-service ni base de datos (usa clientes sintéticos)
+"""
+
+import argparse
+import copy
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+from sklearn.preprocessing import StandardScaler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# app.database crea el esquema al importarse: usar una base temporal
+# (no dejar ml_cache.db en el directorio de trabajo)
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'benchmark.db')}"
+
+from app.services import segmentacion  # noqa: E402
+
+
+def generar_clientes(n: int, seed: int = 42) -> np.ndarray:
+    """Clientes sintéticos: total_compras, frecuencia, ticket_promedio"""
+    rng = np.random.default_rng(seed)
+    grupos = [
+        # (proporción, frecuencia media, ticket medio)
+        (0.15, 20, 45.0),  # VIP
+        (0.35, 8, 22.0),   # Regular
+        (0.50, 2, 9.0),    # Ocasional
+    ]
+    bloques = []
+    for proporcion, frecuencia, ticket in grupos:
+        m = int(n * proporcion)
+        f = np.maximum(1, rng.poisson(frecuencia, m))
+        t = np.maximum(1.0, rng.normal(ticket, ticket * 0.25, m))
+        bloques.append(np.column_stack([f * t, f, t]))
+    X = np.vstack(bloques)
+    rng.shuffle(X)
+    return X
+
+
+def segmentos(model, scaler, X, cluster_map=None) -> np.ndarray:
+    cluster_map = cluster_map or segmentacion._cluster_map(model, scaler)
+    labels = model.predict(scaler.transform(X))
+    return np.array([cluster_map[int(c)] for c in labels])
+
+
+def cronometrar(funcion):
+    inicio = time.perf_counter()
+    resultado = funcion()
+    return resultado, time.perf_counter() - inicio
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de segmentación de clientes")
+    parser.add_argument("--clientes", type=int, default=200000)
+    parser.add_argument("--nuevos", type=float, default=0.05, help="Fracción de clientes nuevos por sync")
+    args = parser.parse_args()
+
+    X = generar_clientes(args.clientes)
+    corte = int(len(X) * (1 - args.nuevos))
+    X_base, X_nuevos = X[:corte], X[corte:]
+
+    print(f"Clientes: {len(X)} (base {len(X_base)}, nuevos {len(X_nuevos)})")
+    print(f"Batch size: {segmentacion.SEGMENTATION_BATCH_SIZE}\n")
+
+    scaler = StandardScaler().fit(X)
+    X_scaled = scaler.transform(X)
+
+    # Referencia: KMeans completo sobre todos los clientes (lo que hace cada sync hoy)
+    kmeans, t_kmeans = cronometrar(lambda: segmentacion._fit_model(X_scaled, "kmeans"))
+    referencia = segmentos(kmeans, scaler, X)
+
+    # MiniBatchKMeans completo
+    minibatch, t_minibatch = cronometrar(lambda: segmentacion._fit_model(X_scaled, "minibatch"))
+    seg_minibatch = segmentos(minibatch, scaler, X)
+
+    # Incremental: modelo entrenado con la base + partial_fit con los nuevos
+    scaler_base = StandardScaler().fit(X_base)
+    base = segmentacion._fit_model(scaler_base.transform(X_base), "minibatch")
+    cluster_map = segmentacion._cluster_map(base, scaler_base)
+    incremental = copy.deepcopy(base)
+    _, t_incremental = cronometrar(
+        lambda: segmentacion._partial_update(incremental, scaler_base.transform(X_nuevos))
+    )
+    seg_incremental = segmentos(incremental, scaler_base, X, cluster_map)
+    mapeo_estable = segmentacion._cluster_map(incremental, scaler_base) == cluster_map
+
+    print(f"{'Motor':<32}{'Tiempo (s)':>12}{'Concordancia':>15}")
+    print(f"{'KMeans completo (referencia)':<32}{t_kmeans:>12.3f}{'100.00%':>15}")
+    print(f"{'MiniBatchKMeans completo':<32}{t_minibatch:>12.3f}{np.mean(seg_minibatch == referencia):>15.2%}")
+    print(f"{'MiniBatchKMeans incremental':<32}{t_incremental:>12.3f}{np.mean(seg_incremental == referencia):>15.2%}")
+    print(f"\nMapeo de segmentos estable tras partial_fit: {'sí' if mapeo_estable else 'no (reentrenamiento completo)'}")
+
+
+if __name__ == "__main__":
+    main()
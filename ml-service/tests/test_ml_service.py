@@ -154,11 +154,32 @@ class MLServiceTester:
             self.print_info("Iniciando sincronización (puede tardar 5-10 segundos)...")
             start = time.time()
             
-            response = requests.post(f"{self.base_url}/sync", timeout=30)
-            elapsed = time.time() - start
+            # Resync completo para que los conteos no dependan de syncs previos
+            response = requests.post(f"{self.base_url}/sync?full=true", timeout=30)
             
-            if response.status_code == 200:
-                data = response.json()
+            if response.status_code == 202:
+                job = response.json()
+                self.print_test(
+                    "Trabajo de sincronización encolado",
+                    True,
+                    f"job_id: {job['job_id']}"
+                )
+                
+                # Esperar a que el trabajo termine (sync + entrenamiento)
+                while job.get('estado') in ('pendiente', 'en_progreso') and time.time() - start < 120:
+                    time.sleep(1)
+                    job = requests.get(f"{self.base_url}/jobs/{job['job_id']}", timeout=5).json()
+                elapsed = time.time() - start
+                
+                if job.get('estado') != 'completado':
+                    self.print_test(
+                        "Sincronización",
+                        False,
+                        f"Estado: {job.get('estado')} - {job.get('error')}"
+                    )
+                    return {}
+                
+                data = job['resultado']['sync']
                 
                 self.print_test(
                     "Sincronización exitosa",
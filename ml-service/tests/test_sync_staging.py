@@ -0,0 +1,163 @@
+"""
+Sync con core-service simulado (httpx.MockTransport)
+Verifica que un error a mitad de la paginación no reemplace la caché
+por un snapshot parcial, y que las sumas acumuladas del sync incremental
+no cuenten dos veces una venta que core-service vuelve a entregar
+
+Uso:
+    pytest tests/test_sync_staging.py -v
+"""
+import asyncio
+import json
+import os
+import tempfile
+
+import httpx
+import pytest
+
+# Base temporal: se configura antes de importar la app
+_tmpdir = tempfile.mkdtemp()
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_tmpdir, 'ml_test.db')}"
+os.environ["MODELS_DIR"] = os.path.join(_tmpdir, "models")
+
+from app.database import SessionLocal, VentaCache, ProductoCache, ClienteMetrics  # noqa: E402
+from app.services import data_sync, staging  # noqa: E402
+
+PAGE_SIZE = 100
+N_VENTAS = 340
+
+
+def _datos():
+    return {
+        "productos": [
+            {"id": str(i), "nombre": f"Producto {i}", "precio": 10.0 + i, "stock": i,
+             "categoria": {"nombre": "General"}}
+            for i in range(1, 6)
+        ],
+        "clientes": [{"id": str(i), "nombre": f"Cliente real {i}"} for i in range(1, 6)],
+        "ventas": [
+            {"id": str(i), "cliente": {"id": str(i % 5 + 1)}, "fecha": "2025-10-01T10:00",
+             "total": 20.0, "detalles": [{"id": "1"}]}
+            for i in range(1, N_VENTAS + 1)
+        ],
+    }
+
+
+def _core_simulado(falla_ventas_desde: int = None, error_graphql: bool = False):
+    """
+    Handler de core-service: pagina por desdeId/limite
+    falla_ventas_desde: responde 500 (o errores GraphQL) al pedir ventas después de ese id
+    """
+    datos = _datos()
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        body = json.loads(request.content)
+        campo = next(c for c in datos if f"{c}(" in body["query"])
+        variables = body["variables"]
+        desde = int(variables["desdeId"] or 0)
+
+        if campo == "ventas" and falla_ventas_desde is not None and desde >= falla_ventas_desde:
+            if error_graphql:
+                return httpx.Response(200, json={"data": None, "errors": [{"message": "timeout"}]})
+            return httpx.Response(500)
+
+        pagina = [r for r in datos[campo] if int(r["id"]) > desde][:variables["limite"]]
+        return httpx.Response(200, json={"data": {campo: pagina}})
+
+    return handler
+
+
+def _core_fijo(ventas: list):
+    """Handler que entrega siempre las mismas ventas, sin respetar el cursor"""
+    datos = _datos()
+    datos["ventas"] = ventas
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        body = json.loads(request.content)
+        campo = next(c for c in datos if f"{c}(" in body["query"])
+        return httpx.Response(200, json={"data": {campo: datos[campo]}})
+
+    return handler
+
+
+def _venta(venta_id: int, cliente_id: int, total: float) -> dict:
+    return {"id": str(venta_id), "cliente": {"id": str(cliente_id)}, "fecha": "2025-10-01T10:00",
+            "total": total, "detalles": [{"id": "1"}]}
+
+
+def _sync_completo(handler, full: bool = True):
+    async def run():
+        data_sync._http_client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        try:
+            db = SessionLocal()
+            try:
+                return await data_sync.sync_data(db, full=full)
+            finally:
+                db.close()
+        finally:
+            await data_sync.close_http_client()
+
+    return asyncio.run(run())
+
+
+def _conteos():
+    db = SessionLocal()
+    try:
+        return (
+            db.query(ProductoCache).count(),
+            db.query(VentaCache).count(),
+            db.query(ClienteMetrics).count(),
+        )
+    finally:
+        db.close()
+
+
+@pytest.fixture(autouse=True)
+def _paginas_chicas(monkeypatch):
+    monkeypatch.setattr(data_sync, "SYNC_PAGE_SIZE", PAGE_SIZE)
+
+
+def test_sync_completo_reemplaza_la_cache():
+    resultado = _sync_completo(_core_simulado())
+
+    assert resultado["errores"] == {}
+    assert _conteos() == (5, N_VENTAS, 5)
+    assert not os.path.exists(staging._sqlite_staging_path())
+
+
+@pytest.mark.parametrize("error_graphql", [False, True])
+def test_error_a_mitad_de_paginas_conserva_la_cache(error_graphql):
+    _sync_completo(_core_simulado())
+    assert _conteos() == (5, N_VENTAS, 5)
+
+    # La primera página de ventas llega bien; la segunda falla
+    with pytest.raises(RuntimeError, match="se conserva la caché anterior"):
+        _sync_completo(_core_simulado(falla_ventas_desde=PAGE_SIZE, error_graphql=error_graphql))
+
+    assert _conteos() == (5, N_VENTAS, 5)
+    assert not os.path.exists(staging._sqlite_staging_path())
+
+
+def test_venta_repetida_no_se_suma_dos_veces():
+    pagina = [_venta(1, 1, 10.0), _venta(2, 1, 15.5), _venta(3, 2, 7.25)]
+    _sync_completo(_core_fijo(pagina))
+
+    # core-service vuelve a entregar la misma página más una venta nueva
+    resultado = _sync_completo(_core_fijo(pagina + [_venta(4, 2, 2.75)]), full=False)
+    assert resultado["ventas_synced"] == 4
+
+    db = SessionLocal()
+    try:
+        metricas = {
+            m.cliente_id: (m.total_compras, m.frecuencia, m.nombre)
+            for m in db.query(ClienteMetrics)
+        }
+        assert metricas == {
+            1: (25.5, 2, "Cliente real 1"),
+            2: (10.0, 2, "Cliente real 2"),
+        }
+        verificacion = data_sync.verify_cliente_metrics(db, corregir=False)
+        assert verificacion["desviados"] == 0
+        assert verificacion["sin_ventas"] == 0
+    finally:
+        db.close()